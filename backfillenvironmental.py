@@ -0,0 +1,159 @@
+#!/bin/python3
+
+# Backfill the measurements table from MisterHouse Omnistat logs.
+#
+# Streams one or more logs (or directories of rotated logs, plain or .gz),
+# keeps the first reading per thermostat per hour, and bulk-loads them with
+# COPY. Hours that already have a row for that station are left alone by the
+# (station_id, recorded_hour) unique index, so it is safe to run over the same
+# logs more than once.
+#
+# Usage: backfillenvironmental.py <log file or directory> [...]
+
+import gzip
+import io
+import os
+import sys
+import time
+from datetime import datetime
+import psycopg2
+
+import envdb
+import envschema
+from updateenvironmental import OMNISTAT_PREFILTER, TSTATS
+
+# Rows per COPY into the staging table
+COPY_BATCH_SIZE = 50000
+
+# NULL in COPY text format
+NULL = r'\N'
+
+
+def log_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            # Oldest first is not required, but makes progress easier to follow
+            names = sorted(os.listdir(path), key=lambda n: os.path.getmtime(os.path.join(path, n)))
+            for name in names:
+                file = os.path.join(path, name)
+                if os.path.isfile(file):
+                    yield file
+        else:
+            yield path
+
+
+def open_log(file):
+    if file.endswith('.gz'):
+        return gzip.open(file, 'rt', errors='replace')
+    return open(file, 'r', errors='replace')
+
+
+# Yields (station, recorded_at, temp, humidity) for the first reading of each
+# thermostat in each hour, across all files. The hour key is taken straight
+# from the log timestamp so strptime only runs once per station-hour.
+def scan_logs(paths):
+    seen = set()
+
+    for file in log_files(paths):
+        print(f"Reading {file}")
+        try:
+            with open_log(file) as log_file:
+                for line in log_file:
+                    if OMNISTAT_PREFILTER not in line:
+                        continue
+
+                    for stat, tstat in TSTATS.items():
+                        if tstat["prefilter"] not in line:
+                            continue
+
+                        match = tstat["pattern"].search(line)
+                        if match:
+                            # "02/12/25 12:20:41 AM" -> "02/12/25 12 AM"
+                            timestamp_str = match.group("timestamp")
+                            key = (tstat["station"], timestamp_str[:11] + timestamp_str[-2:])
+                            if key not in seen:
+                                seen.add(key)
+                                try:
+                                    # Offset for that date, not today's, so DST is right
+                                    recorded_at = datetime.strptime(timestamp_str, "%m/%d/%y %I:%M:%S %p").astimezone()
+                                except ValueError as e:
+                                    print(f"Error parsing timestamp {timestamp_str}: {e}")
+                                    break
+                                humidity = match.group("humidity") if "humidity" in tstat["pattern"].groupindex else None
+                                yield tstat["station"], recorded_at, match.group("temp"), humidity
+                        break
+        except (OSError, EOFError) as e:
+            print(f"Error reading log file {file}: {e}")
+
+
+def copy_batch(cursor, rows):
+    buf = io.StringIO()
+    for station, recorded_at, temp, humidity in rows:
+        if humidity is None:
+            humidity = NULL
+        buf.write(f"{recorded_at.isoformat()}\t{station}\t{temp}\t{humidity}\n")
+    buf.seek(0)
+    cursor.copy_expert(
+        "COPY backfill_measurements (recorded_at, station_id, temperature_f, humidity_percent) FROM STDIN",
+        buf
+    )
+
+
+def backfill(paths):
+    start = time.monotonic()
+
+    try:
+        with envdb.connection() as conn:
+            with conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        CREATE TEMP TABLE backfill_measurements (
+                            recorded_at TIMESTAMP WITH TIME ZONE,
+                            station_id INTEGER,
+                            temperature_f REAL,
+                            humidity_percent REAL
+                        ) ON COMMIT DROP
+                    """)
+
+                    total = 0
+                    rows = []
+                    for row in scan_logs(paths):
+                        rows.append(row)
+                        if len(rows) >= COPY_BATCH_SIZE:
+                            copy_batch(cursor, rows)
+                            total += len(rows)
+                            rows = []
+                    if rows:
+                        copy_batch(cursor, rows)
+                        total += len(rows)
+
+                    # Older logs may reach back before the first partition
+                    cursor.execute("SELECT min(recorded_at), max(recorded_at) FROM backfill_measurements")
+                    first, last = cursor.fetchone()
+                    if first is not None:
+                        envschema.ensure_partitions(cursor, "measurements", first, last)
+
+                    # Hours that already have a row for the station are skipped,
+                    # the rest are added to the rollups as well
+                    cursor.execute(envdb.with_rollups("measurements", """
+                        INSERT INTO measurements (recorded_at, station_id, temperature_f, humidity_percent)
+                        SELECT recorded_at, station_id, temperature_f, humidity_percent
+                        FROM backfill_measurements
+                        ON CONFLICT DO NOTHING
+                    """))
+                    inserted = cursor.fetchone()[0]
+    except psycopg2.DatabaseError as e:
+        print(f"Database error: {e}")
+        return
+    finally:
+        envdb.close()
+
+    print(f"{total} station-hours found, {inserted} inserted in {time.monotonic() - start:.1f}s")
+
+
+## MAIN ##
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python backfillenvironmental.py <log file or directory> [...]")
+        sys.exit(1)
+    backfill(sys.argv[1:])
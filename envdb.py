@@ -0,0 +1,317 @@
+#!/bin/python3
+
+# Shared database access for all ingest scripts.
+#
+# Every table keeps at most one row per station per hour. The hour is stored
+# in the generated recorded_hour column with a unique index on
+# (station_id, recorded_hour) (see envschema.py), so writers just
+# INSERT ... ON CONFLICT DO NOTHING and the first reading of the hour wins,
+# the same as the old SELECT COUNT(*) check but in one round trip and
+# without a race between writers.
+#
+# Without that index ON CONFLICT has nothing to conflict on and every write
+# would add a duplicate row, so write_measurements() checks for it the first
+# time it writes to a table and refuses to write until it is there. Run
+# "envschema.py migrate" when deploying, before starting any writer.
+#
+# Each insert also folds the rows it actually inserted into per-station
+# hourly and daily rollup tables (<table>_hourly, <table>_daily) in the same
+# statement, so the rollups never disagree with the raw rows. Hourly buckets
+# are UTC hours, daily buckets are days in ROLLUP_TIMEZONE (default UTC).
+# See envquery.py for reading them.
+#
+# Connections come from one pool per process and are reused for the whole
+# run (or the life of a daemon). Inserts go through server-side prepared
+# statements, prepared once per connection. Tunable from .env:
+#   DB_CONNECT_TIMEOUT    seconds to wait for a connection (default 10)
+#   DB_STATEMENT_TIMEOUT  milliseconds before a statement is cancelled (default 30000)
+#   DB_RETRIES            attempts when the server is unreachable (default 3)
+#   DB_RETRY_DELAY        seconds between attempts (default 2)
+#   DB_POOL_SIZE          most connections held open (default 4)
+
+import os
+import re
+import time
+import zlib
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+
+# Tables we write to and the columns each one accepts
+TABLES = {
+    "measurements": (
+        "recorded_at", "station_id", "temperature_f", "humidity_percent", "pressure_inhg",
+        "dewpoint", "gas", "sealevelpressure", "stationpressure", "updays",
+        "airquality", "airqualityqual", "deviations", "errors",
+    ),
+    "indoor_measurements": (
+        "recorded_at", "station_id", "temperature_f", "humidity_percent",
+    ),
+}
+
+# Columns summarized in the rollup tables, by metric name
+ROLLUP_METRICS = {
+    "measurements": {
+        "temperature": "temperature_f",
+        "humidity": "humidity_percent",
+        "pressure": "pressure_inhg",
+    },
+    "indoor_measurements": {
+        "temperature": "temperature_f",
+        "humidity": "humidity_percent",
+    },
+}
+
+# The hour bucket is taken in UTC so the expression is immutable (allowed in a
+# generated column). For whole-hour timezones it is the same hour as the old
+# DATE_TRUNC('hour', recorded_at) check.
+HOUR_BUCKET_SQL = "date_trunc('hour', recorded_at AT TIME ZONE 'UTC')"
+
+# Errors that mean the connection (not the statement) is bad
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+# Created on first use, see get_pool()
+pool = None
+
+# Tables whose one-row-per-station-hour index has been found, see check_schema()
+checked_tables = set()
+
+
+class SchemaNotMigrated(Exception):
+    """The table is missing the unique index envschema.py migrate creates"""
+
+
+class RejectedRows(Exception):
+    """The database refused the rows themselves, retrying won't help"""
+
+
+# SQLSTATE classes for errors caused by the rows or the statement rather
+# than the server's state: data exceptions, integrity violations and
+# syntax/undefined objects. check_violation is left out, it is what an
+# insert with no partition to go to raises, and maintain fixes that.
+PERMANENT_ERROR_CLASSES = ("22", "23", "42")
+TRANSIENT_ERROR_CODES = ("23514",)
+
+
+def is_permanent(e):
+    code = getattr(e, "pgcode", None) or ""
+    return code[:2] in PERMANENT_ERROR_CLASSES and code not in TRANSIENT_ERROR_CODES
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """Connection that remembers which statements it has PREPAREd"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+    # PREPARE sql as name on this connection, once
+    def prepare(self, cursor, name, sql):
+        if name not in self.prepared:
+            cursor.execute(f"PREPARE {name} AS {sql}")
+            self.prepared.add(name)
+
+
+def getenv_number(name, default):
+    try:
+        return type(default)(os.getenv(name, default))
+    except ValueError:
+        print(f"Invalid {name}, using {default}")
+        return default
+
+
+def get_pool():
+    global pool
+    if pool is None:
+        pool = psycopg2.pool.ThreadedConnectionPool(
+            0,
+            getenv_number("DB_POOL_SIZE", 4),
+            connection_factory=PreparingConnection,
+            dbname=os.getenv("DB_NAME"),
+            user=os.getenv("DB_USER"),
+            password=os.getenv("DB_PASS"),
+            host=os.getenv("DB_HOST"),
+            port=os.getenv("DB_PORT"),
+            connect_timeout=getenv_number("DB_CONNECT_TIMEOUT", 10),
+            options=f'-c statement_timeout={getenv_number("DB_STATEMENT_TIMEOUT", 30000)}'
+        )
+    return pool
+
+
+# Borrow a pooled connection. A connection that failed is closed rather than
+# handed back, so the next borrower gets a fresh one.
+@contextmanager
+def connection():
+    conn = get_pool().getconn()
+    try:
+        yield conn
+    except CONNECTION_ERRORS:
+        get_pool().putconn(conn, close=True)
+        raise
+    except BaseException:
+        if not conn.closed:
+            conn.rollback()
+        get_pool().putconn(conn)
+        raise
+    else:
+        get_pool().putconn(conn)
+
+
+# Run work(conn) in one transaction, retrying while the server can't be
+# reached. Other database errors are not retried.
+def run_with_retries(work):
+    retries = getenv_number("DB_RETRIES", 3)
+    delay = getenv_number("DB_RETRY_DELAY", 2)
+
+    for attempt in range(1, retries + 1):
+        try:
+            with connection() as conn:
+                with conn:
+                    return work(conn)
+        except CONNECTION_ERRORS as e:
+            if attempt == retries:
+                raise
+            print(f"Database unreachable ({e}), retry {attempt} of {retries - 1} in {delay}s")
+            time.sleep(delay)
+
+
+def close():
+    global pool
+    if pool is not None:
+        try:
+            pool.closeall()
+        except Exception:
+            pass
+        pool = None
+
+
+def rollup_timezone():
+    tz = os.getenv("ROLLUP_TIMEZONE", "UTC")
+    if not re.fullmatch(r"[A-Za-z0-9_/+-]+", tz):
+        raise ValueError(f"Invalid ROLLUP_TIMEZONE: {tz}")
+    return tz
+
+
+# Rollup name -> SQL for the bucket a raw row falls in
+def rollup_buckets():
+    return {
+        "hourly": HOUR_BUCKET_SQL,
+        "daily": f"(recorded_at AT TIME ZONE '{rollup_timezone()}')::date",
+    }
+
+
+# Aggregate select list for table's rollup columns, in rollup_columns() order
+def rollup_aggregates(table, bucket):
+    aggs = ["station_id", bucket, "count(*)"]
+    for column in ROLLUP_METRICS[table].values():
+        aggs += [f"min({column})", f"max({column})", f"coalesce(sum({column}), 0)", f"count({column})"]
+    return aggs
+
+
+def rollup_columns(table):
+    columns = ["station_id", "bucket", "samples"]
+    for metric in ROLLUP_METRICS[table]:
+        columns += [f"{metric}_min", f"{metric}_max", f"{metric}_sum", f"{metric}_count"]
+    return columns
+
+
+# Turn insert_sql, an "INSERT INTO table ... ON CONFLICT DO NOTHING", into a
+# statement that also adds the rows it inserted to the hourly and daily
+# rollups. The statement returns the number of rows inserted.
+def with_rollups(table, insert_sql):
+    metrics = ROLLUP_METRICS[table]
+    ctes = [f"ins AS ({insert_sql} RETURNING station_id, recorded_at, {', '.join(metrics.values())})"]
+
+    for name, bucket in rollup_buckets().items():
+        rollup = f"{table}_{name}"
+        updates = [f"samples = {rollup}.samples + EXCLUDED.samples"]
+        for metric in metrics:
+            updates += [
+                f"{metric}_min = LEAST({rollup}.{metric}_min, EXCLUDED.{metric}_min)",
+                f"{metric}_max = GREATEST({rollup}.{metric}_max, EXCLUDED.{metric}_max)",
+                f"{metric}_sum = {rollup}.{metric}_sum + EXCLUDED.{metric}_sum",
+                f"{metric}_count = {rollup}.{metric}_count + EXCLUDED.{metric}_count",
+            ]
+        # Grouped first, an upsert can't touch the same bucket twice
+        ctes.append(
+            f"{name} AS (INSERT INTO {rollup} ({', '.join(rollup_columns(table))}) "
+            f"SELECT {', '.join(rollup_aggregates(table, bucket))} FROM ins GROUP BY 1, 2 "
+            f"ON CONFLICT (station_id, bucket) DO UPDATE SET {', '.join(updates)})"
+        )
+
+    return f"WITH {', '.join(ctes)} SELECT count(*) FROM ins"
+
+
+# Raise SchemaNotMigrated unless table has the (station_id, recorded_hour)
+# unique index. Partitioned tables carry it on each partition instead (see
+# envschema.ensure_partitions). Checked once per table per process.
+def check_schema(cursor, table):
+    if table in checked_tables:
+        return
+    cursor.execute(
+        "SELECT to_regclass(%s) IS NOT NULL "
+        "OR EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))",
+        (f"{table}_station_hour_key", table)
+    )
+    if not cursor.fetchone()[0]:
+        raise SchemaNotMigrated(
+            f"{table} has no {table}_station_hour_key unique index, every write would add duplicates. "
+            f"Run 'envschema.py migrate' first."
+        )
+    checked_tables.add(table)
+
+
+def insert_statement(table, columns):
+    placeholders = ", ".join(f"${i}" for i in range(1, len(columns) + 1))
+    sql = with_rollups(
+        table,
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders}) ON CONFLICT DO NOTHING"
+    )
+    name = f"envdb_{table}_{zlib.crc32(sql.encode()):08x}"
+    return name, sql
+
+
+# Write a batch of readings to table in one transaction.
+# rows is a list of dicts of column -> value, each with at least recorded_at
+# and station_id. Columns that are None are left to the table default.
+# Hours already present are skipped. Returns True if the batch was written,
+# False if it wasn't but may be later (server unreachable, or the table
+# hasn't been migrated, see check_schema()). Raises RejectedRows if the
+# database rejected the batch outright, see is_permanent().
+def write_measurements(table, rows):
+    if table not in TABLES:
+        raise ValueError(f"Unknown measurements table: {table}")
+
+    # Rows with the same set of columns share a prepared statement
+    groups = {}
+    for row in rows:
+        columns = tuple(c for c in TABLES[table] if row.get(c) is not None)
+        groups.setdefault(columns, []).append(tuple(row[c] for c in columns))
+
+    if not groups:
+        return True
+
+    def work(conn):
+        with conn.cursor() as cursor:
+            check_schema(cursor, table)
+            for columns, values in groups.items():
+                name, sql = insert_statement(table, columns)
+                conn.prepare(cursor, name, sql)
+                params = ", ".join(["%s"] * len(columns))
+                psycopg2.extras.execute_batch(cursor, f"EXECUTE {name} ({params})", values)
+
+    try:
+        run_with_retries(work)
+        return True
+    except SchemaNotMigrated as e:
+        print(f"Not writing to {table}: {e}")
+    except psycopg2.DatabaseError as e:
+        print(f"Database error: {e}")
+        if is_permanent(e):
+            raise RejectedRows(str(e)) from e
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+
+    return False
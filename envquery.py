@@ -0,0 +1,114 @@
+#!/bin/python3
+
+# Read side of the measurement rollups kept by envdb.py.
+#
+# Queries go to the hourly rollup for short ranges and the daily rollup for
+# long ones, so a year of readings is a few hundred rows rather than a scan
+# of the raw tables.
+#
+# Usage: envquery.py <station_id> <start> <end> [measurements|indoor_measurements]
+#        start/end are ISO dates or datetimes, local time if no offset given
+
+import sys
+from datetime import datetime, timedelta
+import psycopg2
+import psycopg2.extras
+from dotenv import load_dotenv
+
+import envdb
+
+# Longest range served from the hourly rollup
+HOURLY_MAX_SPAN = timedelta(days=31)
+
+
+def pick_rollup(start, end):
+    return "hourly" if end - start <= HOURLY_MAX_SPAN else "daily"
+
+
+# WHERE clause limiting a rollup to [start, end)
+def bucket_range_sql(rollup):
+    if rollup == "hourly":
+        return "bucket >= (%(start)s::timestamptz AT TIME ZONE 'UTC') AND bucket < (%(end)s::timestamptz AT TIME ZONE 'UTC')"
+    tz = envdb.rollup_timezone()
+    return f"bucket >= (%(start)s::timestamptz AT TIME ZONE '{tz}')::date AND bucket < (%(end)s::timestamptz AT TIME ZONE '{tz}')::date"
+
+
+def query(sql, params):
+    def work(conn):
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+    return envdb.run_with_retries(work)
+
+
+# Per-bucket min/max/avg for one station between start and end (aware
+# datetimes). rollup is "hourly" or "daily", picked from the range if None.
+# Returns a list of dicts: bucket, samples, <metric>_min/_max/_avg.
+def series(station_id, start, end, table="measurements", rollup=None):
+    rollup = rollup or pick_rollup(start, end)
+    select = ["bucket", "samples"]
+    for metric in envdb.ROLLUP_METRICS[table]:
+        select += [
+            f"{metric}_min",
+            f"{metric}_max",
+            f"{metric}_sum / NULLIF({metric}_count, 0) AS {metric}_avg",
+        ]
+    return query(
+        f"SELECT {', '.join(select)} FROM {table}_{rollup} "
+        f"WHERE station_id = %(station)s AND {bucket_range_sql(rollup)} ORDER BY bucket",
+        {"station": station_id, "start": start, "end": end}
+    )
+
+
+# min/max/avg over the whole range for one station, as a single dict
+def summary(station_id, start, end, table="measurements", rollup=None):
+    rollup = rollup or pick_rollup(start, end)
+    select = ["count(*) AS buckets", "coalesce(sum(samples), 0) AS samples"]
+    for metric in envdb.ROLLUP_METRICS[table]:
+        select += [
+            f"min({metric}_min) AS {metric}_min",
+            f"max({metric}_max) AS {metric}_max",
+            f"sum({metric}_sum) / NULLIF(sum({metric}_count), 0) AS {metric}_avg",
+        ]
+    rows = query(
+        f"SELECT {', '.join(select)} FROM {table}_{rollup} "
+        f"WHERE station_id = %(station)s AND {bucket_range_sql(rollup)}",
+        {"station": station_id, "start": start, "end": end}
+    )
+    return rows[0]
+
+
+def parse_time(value):
+    # Naive times are taken as local time
+    return datetime.fromisoformat(value).astimezone()
+
+
+## MAIN ##
+if __name__ == "__main__":
+    load_dotenv()
+
+    if len(sys.argv) not in (4, 5):
+        print("Usage: python envquery.py <station_id> <start> <end> [measurements|indoor_measurements]")
+        sys.exit(1)
+
+    try:
+        station = int(sys.argv[1])
+        start = parse_time(sys.argv[2])
+        end = parse_time(sys.argv[3])
+        table = sys.argv[4] if len(sys.argv) == 5 else "measurements"
+        if table not in envdb.ROLLUP_METRICS:
+            raise ValueError(f"Unknown table: {table}")
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    try:
+        rollup = pick_rollup(start, end)
+        for row in series(station, start, end, table, rollup):
+            print("\t".join(str(v) for v in row.values()))
+        print(f"{rollup} summary: {dict(summary(station, start, end, table, rollup))}")
+    except psycopg2.DatabaseError as e:
+        print(f"Database error: {e}")
+        sys.exit(1)
+    finally:
+        envdb.close()
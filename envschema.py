@@ -0,0 +1,323 @@
+#!/bin/python3
+
+# Schema management for the measurements tables.
+#
+# Usage: envschema.py migrate | rebuild-rollups
+#
+#   migrate          add the recorded_hour bucket column and the one-row-per-
+#                    station-per-hour unique index that envdb.py relies on,
+#                    and create the hourly/daily rollup tables (filled from
+#                    the raw rows the first time). Safe to re-run.
+#   rebuild-rollups  recompute every rollup table from the raw rows, e.g.
+#                    after changing ROLLUP_TIMEZONE
+#   partition        move measurements to a table range-partitioned by month
+#                    on recorded_at. The old table is kept, renamed to
+#                    measurements_unpartitioned, until you drop it. Serial
+#                    sequences move to the new table, identity columns get
+#                    new sequences carrying on from the old ones, and the
+#                    primary key is
+#                    recreated with recorded_at added (a partitioned table's
+#                    key must include the partition column). Other unique
+#                    indexes and foreign keys are not carried over.
+#                    Restart the ingest daemon afterwards.
+#   maintain         create partitions through PARTITIONS_AHEAD months from
+#                    now (run from cron, monthly or more often)
+#   detach YYYY-MM   detach that month's partition as a standalone table, to
+#                    be archived (pg_dump) or dropped. Metadata only, O(1).
+#                    The rollup tables still count the detached rows, run
+#                    rebuild-rollups if they should only cover what is left.
+
+import sys
+from datetime import datetime, timezone
+import psycopg2
+from dotenv import load_dotenv
+
+import envdb
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Tables that are partitioned by month
+PARTITIONED_TABLES = ("measurements",)
+
+# Months of partitions kept ready past the current one. An insert with no
+# partition fails, and the reading waits in the outbox until maintain runs.
+PARTITIONS_AHEAD = 3
+
+
+def migrate_hour_bucket(cursor, table):
+    if is_partitioned(cursor, table):
+        # Bucket column came across with the table, and each partition
+        # carries its own unique index (see ensure_partitions)
+        return
+
+    cursor.execute(f"""
+        ALTER TABLE {table}
+        ADD COLUMN IF NOT EXISTS recorded_hour TIMESTAMP
+        GENERATED ALWAYS AS ({envdb.HOUR_BUCKET_SQL}) STORED
+    """)
+
+    # Racing writers could have left more than one row in an hour,
+    # keep the earliest so the unique index can be built
+    cursor.execute(f"""
+        DELETE FROM {table} WHERE ctid IN (
+            SELECT ctid FROM (
+                SELECT ctid, row_number() OVER (
+                    PARTITION BY station_id, recorded_hour ORDER BY recorded_at
+                ) AS n
+                FROM {table}
+            ) d WHERE d.n > 1
+        )
+    """)
+    if cursor.rowcount:
+        print(f"{table}: removed {cursor.rowcount} duplicate station-hour rows")
+
+    cursor.execute(f"""
+        CREATE UNIQUE INDEX IF NOT EXISTS {table}_station_hour_key
+        ON {table} (station_id, recorded_hour)
+    """)
+    print(f"{table}: hour bucket and unique index in place")
+
+
+def rebuild_rollup(cursor, table, name, bucket):
+    rollup = f"{table}_{name}"
+    cursor.execute(f"TRUNCATE {rollup}")
+    cursor.execute(f"""
+        INSERT INTO {rollup} ({', '.join(envdb.rollup_columns(table))})
+        SELECT {', '.join(envdb.rollup_aggregates(table, bucket))}
+        FROM {table}
+        GROUP BY 1, 2
+    """)
+    print(f"{rollup}: rebuilt {cursor.rowcount} buckets")
+
+
+def migrate_rollups(cursor, table):
+    bucket_types = {"hourly": "TIMESTAMP", "daily": "DATE"}
+
+    for name, bucket in envdb.rollup_buckets().items():
+        rollup = f"{table}_{name}"
+        cursor.execute("SELECT to_regclass(%s)", (rollup,))
+        exists = cursor.fetchone()[0] is not None
+
+        metric_columns = []
+        for metric in envdb.ROLLUP_METRICS[table]:
+            metric_columns += [
+                f"{metric}_min DOUBLE PRECISION",
+                f"{metric}_max DOUBLE PRECISION",
+                f"{metric}_sum DOUBLE PRECISION NOT NULL DEFAULT 0",
+                f"{metric}_count INTEGER NOT NULL DEFAULT 0",
+            ]
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {rollup} (
+                station_id INTEGER NOT NULL,
+                bucket {bucket_types[name]} NOT NULL,
+                samples INTEGER NOT NULL,
+                {', '.join(metric_columns)},
+                PRIMARY KEY (station_id, bucket)
+            )
+        """)
+
+        if not exists:
+            rebuild_rollup(cursor, table, name, bucket)
+
+
+def month_start(ts):
+    return datetime(ts.year, ts.month, 1, tzinfo=timezone.utc)
+
+
+def next_month(ts):
+    return datetime(ts.year + ts.month // 12, ts.month % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(table, month):
+    return f"{table}_y{month.year:04d}m{month.month:02d}"
+
+
+def is_partitioned(cursor, table):
+    cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", (table,))
+    return cursor.fetchone() is not None
+
+
+# Create any missing monthly partitions of table covering start..end.
+# Bounds are UTC month starts, which are also UTC hour boundaries, so the
+# per-partition (station_id, recorded_hour) unique index is unique overall.
+# Does nothing if table isn't partitioned.
+def ensure_partitions(cursor, table, start, end):
+    if not is_partitioned(cursor, table):
+        return
+
+    month = month_start(start.astimezone(timezone.utc))
+    while month <= end:
+        name = partition_name(table, month)
+        cursor.execute("SELECT to_regclass(%s)", (name,))
+        if cursor.fetchone()[0] is None:
+            cursor.execute(
+                f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)",
+                (month, next_month(month))
+            )
+            cursor.execute(f"CREATE UNIQUE INDEX {name}_station_hour_key ON {name} (station_id, recorded_hour)")
+            print(f"{name}: created")
+        month = next_month(month)
+
+
+def months_ahead(now):
+    end = month_start(now)
+    for _ in range(PARTITIONS_AHEAD):
+        end = next_month(end)
+    return end
+
+
+def partition_table(cursor, table):
+    if is_partitioned(cursor, table):
+        print(f"{table}: already partitioned")
+        return
+
+    old = f"{table}_unpartitioned"
+    cursor.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+
+    # Everything but the generated hour bucket is copied across
+    cursor.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND is_generated = 'NEVER'
+        ORDER BY ordinal_position
+    """, (table,))
+    columns = ", ".join(row[0] for row in cursor.fetchall())
+
+    cursor.execute("""
+        SELECT attname FROM pg_attribute
+        WHERE attrelid = to_regclass(%s) AND attidentity <> '' AND NOT attisdropped
+    """, (table,))
+    identity = [row[0] for row in cursor.fetchall()]
+
+    # Primary key columns, in key order
+    cursor.execute("""
+        SELECT c.conname, array_agg(a.attname ORDER BY k.n)
+        FROM pg_constraint c
+        CROSS JOIN unnest(c.conkey) WITH ORDINALITY AS k(attnum, n)
+        JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = k.attnum
+        WHERE c.conrelid = to_regclass(%s) AND c.contype = 'p'
+        GROUP BY c.conname
+    """, (table,))
+    primary_key = cursor.fetchone()
+
+    cursor.execute(f"ALTER TABLE {table} RENAME TO {old}")
+    cursor.execute(f"""
+        CREATE TABLE {table} (
+            LIKE {old} INCLUDING DEFAULTS INCLUDING GENERATED INCLUDING CONSTRAINTS INCLUDING IDENTITY
+        )
+        PARTITION BY RANGE (recorded_at)
+    """)
+
+    # Serial columns keep calling the old table's sequences. Hand them to the
+    # new table, or dropping the old one fails (or with CASCADE takes the
+    # new table's defaults with it). Identity sequences can't change hands,
+    # LIKE gave the new table its own.
+    for column in columns.split(", "):
+        if column in identity:
+            continue
+        cursor.execute("SELECT pg_get_serial_sequence(%s, %s)", (old, column))
+        sequence = cursor.fetchone()[0]
+        if sequence is not None:
+            cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {table}.{column}")
+
+    # The key's name stays with the old table, free it up first
+    if primary_key is not None:
+        name, key = primary_key
+        if "recorded_at" not in key:
+            key.append("recorded_at")
+        cursor.execute(f"ALTER TABLE {old} RENAME CONSTRAINT {name} TO {old}_pkey")
+        cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} PRIMARY KEY ({', '.join(key)})")
+
+    # Lookups are by station over a time range, and rows arrive in time
+    # order, so BRIN on recorded_at stays tiny and btree serves per-station
+    cursor.execute(f"CREATE INDEX {table}_recorded_at_brin ON {table} USING brin (recorded_at)")
+    cursor.execute(f"CREATE INDEX {table}_station_recorded_at ON {table} (station_id, recorded_at)")
+
+    cursor.execute(f"SELECT min(recorded_at) FROM {old}")
+    first = cursor.fetchone()[0] or datetime.now(timezone.utc)
+    ensure_partitions(cursor, table, first, months_ahead(datetime.now(timezone.utc)))
+
+    cursor.execute(f"INSERT INTO {table} ({columns}) OVERRIDING SYSTEM VALUE SELECT {columns} FROM {old}")
+    moved = cursor.rowcount
+
+    # New identity sequences start over, carry on from the old ones instead
+    for column in identity:
+        cursor.execute(
+            "SELECT pg_get_serial_sequence(%s, %s), pg_get_serial_sequence(%s, %s)",
+            (old, column, table, column)
+        )
+        old_sequence, sequence = cursor.fetchone()
+        cursor.execute(f"SELECT last_value, is_called FROM {old_sequence}")
+        cursor.execute("SELECT setval(%s, %s, %s)", (sequence,) + cursor.fetchone())
+
+    print(f"{table}: partitioned, {moved} rows moved, old table kept as {old}")
+
+
+def partition(cursor):
+    for table in PARTITIONED_TABLES:
+        partition_table(cursor, table)
+
+
+def maintain(cursor):
+    for table in PARTITIONED_TABLES:
+        ensure_partitions(cursor, table, datetime.now(timezone.utc), months_ahead(datetime.now(timezone.utc)))
+
+
+def detach(cursor, month):
+    month = datetime.strptime(month, "%Y-%m").replace(tzinfo=timezone.utc)
+    for table in PARTITIONED_TABLES:
+        name = partition_name(table, month)
+        cursor.execute("SELECT to_regclass(%s)", (name,))
+        if cursor.fetchone()[0] is None:
+            print(f"{name}: no such partition")
+            continue
+        cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+        print(f"{name}: detached, archive with pg_dump -t {name} or DROP TABLE {name}")
+        print(f"{table} rollups still include its rows, run rebuild-rollups to drop them")
+
+
+def migrate(cursor):
+    for table in envdb.TABLES:
+        migrate_hour_bucket(cursor, table)
+        migrate_rollups(cursor, table)
+
+
+def rebuild_rollups(cursor):
+    for table in envdb.TABLES:
+        for name, bucket in envdb.rollup_buckets().items():
+            rebuild_rollup(cursor, table, name, bucket)
+
+
+# Run command(cursor, *args) in one transaction
+def run(command, *args):
+    try:
+        with envdb.connection() as conn:
+            with conn:
+                with conn.cursor() as cursor:
+                    command(cursor, *args)
+    except psycopg2.DatabaseError as e:
+        print(f"Database error: {e}")
+        return 1
+    except (TypeError, ValueError) as e:
+        print(f"Error: {e}")
+        return 1
+    finally:
+        envdb.close()
+    return 0
+
+
+COMMANDS = {
+    "migrate": migrate,
+    "rebuild-rollups": rebuild_rollups,
+    "partition": partition,
+    "maintain": maintain,
+    "detach": detach,
+}
+
+
+## MAIN ##
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        print(f"Usage: python envschema.py {' | '.join(COMMANDS)} [YYYY-MM]")
+        sys.exit(1)
+    sys.exit(run(COMMANDS[sys.argv[1]], *sys.argv[2:]))
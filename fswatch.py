@@ -0,0 +1,121 @@
+#!/bin/python3
+
+# Minimal inotify wrapper (Linux only, no extra packages needed on the Pi)
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_Q_OVERFLOW = 0x00004000
+
+# A file was replaced by an atomic rename, or finished being written
+IN_REPLACED = IN_CLOSE_WRITE | IN_MOVED_TO
+# A file was appended to (logs), or replaced
+IN_CHANGED = IN_MODIFY | IN_CREATE | IN_REPLACED
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+_event = struct.Struct('iIII')
+
+
+class Watcher:
+    """Watch a set of files for changes.
+
+    The directory holding each file is watched rather than the file itself,
+    so files replaced by tmpfile + os.rename() and rotated logs are still
+    seen. read() returns the set of watched paths that changed.
+    wake() makes a blocked read() return early, and is safe to call from a
+    signal handler.
+    """
+
+    def __init__(self):
+        self.fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1: {os.strerror(err)}")
+        self.dirs = {}   # wd -> directory
+        self.wds = {}    # directory -> wd
+        self.files = {}  # (directory, name) -> (path, mask)
+        self.wake_r, self.wake_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+
+    def add(self, path, mask=IN_CHANGED):
+        directory, name = os.path.split(os.path.abspath(path))
+        if directory not in self.wds:
+            wd = _libc.inotify_add_watch(self.fd, directory.encode(),
+                                         IN_CHANGED | IN_DELETE_SELF | IN_MOVE_SELF)
+            if wd < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, f"inotify_add_watch {directory}: {os.strerror(err)}")
+            self.wds[directory] = wd
+            self.dirs[wd] = directory
+        self.files[(directory, name)] = (path, mask)
+
+    def fileno(self):
+        return self.fd
+
+    def wake(self):
+        try:
+            os.write(self.wake_w, b'\0')
+        except BlockingIOError:
+            pass
+
+    # Wait up to timeout seconds (None waits forever, 0 polls) and return
+    # the set of watched paths that changed. A queue overflow reports
+    # every watched path as changed so nothing is missed.
+    def read(self, timeout=None):
+        changed = set()
+        if timeout != 0:
+            ready, _, _ = select.select([self.fd, self.wake_r], [], [], timeout)
+            if self.wake_r in ready:
+                try:
+                    os.read(self.wake_r, 4096)
+                except BlockingIOError:
+                    pass
+            if self.fd not in ready:
+                return changed
+
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            pos = 0
+            while pos + _event.size <= len(data):
+                wd, mask, cookie, length = _event.unpack_from(data, pos)
+                name = data[pos + _event.size:pos + _event.size + length].rstrip(b'\0').decode(errors='replace')
+                pos += _event.size + length
+
+                if mask & IN_Q_OVERFLOW:
+                    changed.update(path for path, _ in self.files.values())
+                    continue
+                if mask & IN_IGNORED:
+                    self.wds.pop(self.dirs.pop(wd, None), None)
+                    continue
+
+                watched = self.files.get((self.dirs.get(wd), name))
+                if watched and mask & watched[1]:
+                    changed.add(watched[0])
+
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            os.close(self.wake_r)
+            os.close(self.wake_w)
+            self.fd = -1
@@ -0,0 +1,391 @@
+#!/bin/python3
+
+# Append-only binary journal of heater decisions and relay transitions.
+#
+# thermostat2.py appends one record for every control decision and one for
+# every relay switch, under HEATER_JOURNAL_PATH (default
+# OUTPUT_FILE_PATH/heater-journal). Records are fixed width, so a segment is
+# just an array of them and can be bisected by time without parsing text.
+#
+# Layout:
+#   current            segment being appended to
+#   seg-<ns>.bin       sealed segments, oldest first
+#   index              one entry per sealed segment: first and last record
+#                      time, record count and the segment's <ns>
+#
+# Each record is RECORD followed by the crc32 of those bytes. Records are
+# written straight away (they survive the daemon crashing) but fsynced in
+# batches of SYNC_RECORDS or every SYNC_INTERVAL seconds, whichever comes
+# first, and on close(). A torn record at the end of current is cut off on
+# the next open. Reads skip records that fail the CRC check.
+#
+# Usage: heaterjournal.py dump <start> <end> [pin]
+#        heaterjournal.py duty <start> <end>
+#        heaterjournal.py status
+#        start/end are ISO dates or datetimes, local time if no offset given
+
+import logging
+import math
+import os
+import struct
+import sys
+import time
+import zlib
+from bisect import bisect_left
+from collections import namedtuple
+from datetime import datetime
+from dotenv import load_dotenv
+
+# Record kinds
+DECISION = 0
+TRANSITION = 1
+KINDS = ("decision", "transition")
+
+# Decision branches, as taken by Thermostat.control_temperature. A
+# transition record carries the branch of the decision that caused it.
+STARTUP = 0
+NO_DATA = 1
+AWAY = 2
+BELOW_BAND = 3
+ABOVE_BAND = 4
+IN_BAND = 5
+OUTDOOR_DISABLED = 6
+OUTSIDE_HOURS = 7
+SHUTDOWN = 8
+BRANCHES = ("startup", "no_data", "away", "below_band", "above_band", "in_band",
+            "outdoor_disabled", "outside_hours", "shutdown")
+
+# time, kind, pin, branch, flags, indoor, outdoor, setpoint, hysteresis,
+# start_hour, end_hour, outdoor_disable_point. Missing temperatures and
+# disable points are NaN.
+RECORD = struct.Struct('<dBBBBffffBBxxf')
+CRC = struct.Struct('<I')
+RECORD_SIZE = RECORD.size + CRC.size
+
+# first time, last time, records, segment <ns>
+INDEX_ENTRY = struct.Struct('<ddIQ')
+
+FLAG_WANTED = 0x01
+FLAG_ON = 0x02
+FLAG_HOME = 0x04
+
+# Seal the current segment once it holds this many records
+SEGMENT_RECORDS = 65536
+# Most disk the journal may use, oldest sealed segments are dropped beyond this
+MAX_JOURNAL_BYTES = 256 * 1024 * 1024
+# fsync after this many records, or this many seconds after the first unsynced one
+SYNC_RECORDS = 64
+SYNC_INTERVAL = 60
+
+# For duty(): a zone with no record for this long (seconds) wasn't running
+DUTY_GAP_LIMIT = 300
+
+Record = namedtuple("Record", (
+    "time", "kind", "pin", "branch", "heating_wanted", "heating_on", "home",
+    "indoor_temperature", "outdoor_temperature", "setpoint_temperature",
+    "hysteresis", "start_hour", "end_hour", "outdoor_disable_point",
+))
+
+
+def journal_dir():
+    return os.getenv("HEATER_JOURNAL_PATH") or f'{os.getenv("OUTPUT_FILE_PATH")}/heater-journal'
+
+
+def encode(record):
+    flags = (
+        (FLAG_WANTED if record.heating_wanted else 0)
+        | (FLAG_ON if record.heating_on else 0)
+        | (FLAG_HOME if record.home else 0)
+    )
+    body = RECORD.pack(
+        record.time, record.kind, record.pin, record.branch, flags,
+        *(math.nan if v is None else v for v in (
+            record.indoor_temperature, record.outdoor_temperature,
+            record.setpoint_temperature, record.hysteresis)),
+        record.start_hour, record.end_hour,
+        math.nan if record.outdoor_disable_point is None else record.outdoor_disable_point
+    )
+    return body + CRC.pack(zlib.crc32(body))
+
+
+def decode(data, offset=0):
+    body = data[offset:offset + RECORD.size]
+    (crc,) = CRC.unpack_from(data, offset + RECORD.size)
+    if crc != zlib.crc32(body):
+        return None
+    (t, kind, pin, branch, flags, indoor, outdoor, setpoint, hysteresis,
+     start_hour, end_hour, disable_point) = RECORD.unpack(body)
+    return Record(
+        t, kind, pin, branch, bool(flags & FLAG_WANTED), bool(flags & FLAG_ON), bool(flags & FLAG_HOME),
+        *(None if math.isnan(v) else v for v in (indoor, outdoor, setpoint, hysteresis)),
+        start_hour, end_hour, None if math.isnan(disable_point) else disable_point
+    )
+
+
+def segment_path(segment_id):
+    return os.path.join(journal_dir(), f'seg-{segment_id:020d}.bin')
+
+
+def read_index():
+    try:
+        with open(os.path.join(journal_dir(), 'index'), 'rb') as index:
+            data = index.read()
+    except FileNotFoundError:
+        return []
+    usable = len(data) - len(data) % INDEX_ENTRY.size
+    return [INDEX_ENTRY.unpack_from(data, i) for i in range(0, usable, INDEX_ENTRY.size)]
+
+
+def write_index(entries):
+    path = os.path.join(journal_dir(), 'index')
+    with open(f'{path}.tmp', 'wb') as index:
+        index.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in entries))
+        index.flush()
+        os.fsync(index.fileno())
+    os.rename(f'{path}.tmp', path)
+
+
+# First and last good record times and the record count of a segment file
+def segment_bounds(path):
+    with open(path, 'rb') as segment:
+        data = segment.read()
+    records = [r for r in (decode(data, i) for i in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE)) if r]
+    if not records:
+        return None
+    return records[0].time, records[-1].time, len(data) // RECORD_SIZE
+
+
+class Journal:
+    """Appender for the daemon. Errors are logged, never raised, so a full
+    or broken disk can't stop the heaters being controlled."""
+
+    def __init__(self):
+        self.directory = journal_dir()
+        self.fd = None
+        self.records = 0
+        self.unsynced = 0
+        self.unsynced_since = None
+        self.failed = False
+        self.unencodable = False
+        try:
+            self.open()
+        except OSError as e:
+            logging.error(f"Error opening heater journal {self.directory}: {e}")
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.check_index()
+        current = os.path.join(self.directory, 'current')
+        self.fd = os.open(current, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        size = os.fstat(self.fd).st_size
+        if size % RECORD_SIZE:
+            logging.warning(f"Heater journal: cutting off a torn record at the end of {current}")
+            os.ftruncate(self.fd, size - size % RECORD_SIZE)
+        self.records = size // RECORD_SIZE
+
+    # Add index entries for sealed segments a crash left out, and drop
+    # entries whose segments are gone
+    def check_index(self):
+        entries = read_index()
+        on_disk = sorted(
+            int(n[4:-4]) for n in os.listdir(self.directory) if n.startswith('seg-') and n.endswith('.bin')
+        )
+        indexed = {entry[3] for entry in entries}
+        if indexed == set(on_disk):
+            return
+        entries = [entry for entry in entries if entry[3] in on_disk]
+        for segment_id in on_disk:
+            if segment_id not in indexed:
+                bounds = segment_bounds(segment_path(segment_id))
+                if bounds is not None:
+                    entries.append(bounds + (segment_id,))
+        entries.sort(key=lambda entry: entry[3])
+        write_index(entries)
+
+    def append(self, record):
+        if self.fd is None:
+            return
+        # A field that doesn't fit the record layout (a fractional hour, a
+        # pin that isn't a number) loses the record, not the control pass
+        try:
+            data = encode(record)
+            self.unencodable = False
+        except (struct.error, TypeError, ValueError, OverflowError) as e:
+            if not self.unencodable:
+                logging.error(f"Heater journal: can't record {record}: {e}")
+            self.unencodable = True
+            return
+        try:
+            os.write(self.fd, data)
+            self.records += 1
+            self.unsynced += 1
+            if self.unsynced_since is None:
+                self.unsynced_since = time.monotonic()
+            if self.records >= SEGMENT_RECORDS:
+                self.seal()
+            else:
+                self.sync()
+            self.failed = False
+        except OSError as e:
+            # Once per run of failures, not once per record
+            if not self.failed:
+                logging.error(f"Error writing heater journal {self.directory}: {e}")
+            self.failed = True
+
+    # fsync if a batch is due, or anything is unsynced and force is set.
+    # append() checks after every record, thermostat2.py's main loop calls
+    # this every tick so an idle journal still syncs within SYNC_INTERVAL
+    def sync(self, force=False):
+        if self.fd is None or not self.unsynced:
+            return
+        if force or self.unsynced >= SYNC_RECORDS or time.monotonic() - self.unsynced_since >= SYNC_INTERVAL:
+            os.fsync(self.fd)
+            self.unsynced = 0
+            self.unsynced_since = None
+
+    def seal(self):
+        self.sync(force=True)
+        os.close(self.fd)
+        self.fd = None
+        current = os.path.join(self.directory, 'current')
+        bounds = segment_bounds(current)
+        segment_id = time.time_ns()
+        os.rename(current, segment_path(segment_id))
+        entries = read_index()
+        if bounds is not None:
+            entries.append(bounds + (segment_id,))
+        write_index(self.enforce_limit(entries))
+        self.open()
+
+    def enforce_limit(self, entries):
+        total = sum(entry[2] for entry in entries) * RECORD_SIZE
+        while entries and total > MAX_JOURNAL_BYTES:
+            oldest = entries.pop(0)
+            logging.info(f"Heater journal over {MAX_JOURNAL_BYTES} bytes, dropping {segment_path(oldest[3])}")
+            try:
+                os.remove(segment_path(oldest[3]))
+            except FileNotFoundError:
+                pass
+            total -= oldest[2] * RECORD_SIZE
+        return entries
+
+    def close(self):
+        if self.fd is None:
+            return
+        try:
+            self.sync(force=True)
+            os.close(self.fd)
+        except OSError as e:
+            logging.error(f"Error closing heater journal {self.directory}: {e}")
+        self.fd = None
+
+
+# Records with start <= time < end (epoch seconds), oldest first. The index
+# picks the segments, a bisect finds the first record in each. Segments are
+# assumed to be in time order, a wall clock step back can hide a few records.
+def read_range(start, end):
+    paths = [segment_path(entry[3]) for entry in read_index() if entry[1] >= start and entry[0] < end]
+    paths.append(os.path.join(journal_dir(), 'current'))
+
+    for path in paths:
+        try:
+            with open(path, 'rb') as segment:
+                data = segment.read()
+        except FileNotFoundError:
+            continue
+        count = len(data) // RECORD_SIZE
+        times = _SegmentTimes(data, count)
+        for i in range(bisect_left(times, start), count):
+            record = decode(data, i * RECORD_SIZE)
+            if record is None:
+                continue
+            if record.time >= end:
+                break
+            yield record
+
+
+class _SegmentTimes:
+    """Record times of a segment as a sequence, unpacked on demand for bisect"""
+
+    def __init__(self, data, count):
+        self.data = data
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return struct.unpack_from('<d', self.data, i * RECORD_SIZE)[0]
+
+
+# pin -> (seconds heating, seconds journalled, relay switches) between start
+# and end
+def duty(start, end):
+    totals = {}
+    last = {}
+    for record in read_range(start, end):
+        on_time, covered, switches = totals.get(record.pin, (0.0, 0.0, 0))
+        previous = last.get(record.pin)
+        if previous is not None and record.time - previous.time <= DUTY_GAP_LIMIT:
+            covered += record.time - previous.time
+            if previous.heating_on:
+                on_time += record.time - previous.time
+        if record.kind == TRANSITION:
+            switches += 1
+        totals[record.pin] = (on_time, covered, switches)
+        last[record.pin] = record
+    return totals
+
+
+def status():
+    entries = read_index()
+    current = os.path.join(journal_dir(), 'current')
+    pending = os.path.getsize(current) // RECORD_SIZE if os.path.exists(current) else 0
+    print(f"{journal_dir()}: {len(entries)} sealed segments, {sum(e[2] for e in entries)} records sealed, {pending} in current")
+    if entries:
+        print(f"Oldest record {datetime.fromtimestamp(entries[0][0])}")
+
+
+def parse_time(value):
+    # Naive times are taken as local time
+    return datetime.fromisoformat(value).astimezone().timestamp()
+
+
+## MAIN ##
+if __name__ == "__main__":
+    load_dotenv()
+
+    usage = "Usage: python heaterjournal.py dump <start> <end> [pin] | duty <start> <end> | status"
+    if len(sys.argv) < 2 or sys.argv[1] not in ("dump", "duty", "status"):
+        print(usage)
+        sys.exit(1)
+
+    if sys.argv[1] == "status":
+        status()
+        sys.exit(0)
+
+    try:
+        start = parse_time(sys.argv[2])
+        end = parse_time(sys.argv[3])
+        pin = int(sys.argv[4]) if sys.argv[1] == "dump" and len(sys.argv) == 5 else None
+    except (IndexError, ValueError) as e:
+        print(f"Error: {e}")
+        print(usage)
+        sys.exit(1)
+
+    if sys.argv[1] == "dump":
+        print("\t".join(Record._fields))
+        for record in read_range(start, end):
+            if pin is not None and record.pin != pin:
+                continue
+            values = record._replace(
+                time=datetime.fromtimestamp(record.time).isoformat(sep=' ', timespec='seconds'),
+                kind=KINDS[record.kind],
+                branch=BRANCHES[record.branch] if record.branch < len(BRANCHES) else record.branch,
+            )
+            print("\t".join("" if v is None else str(round(v, 2) if isinstance(v, float) else v) for v in values))
+    else:
+        print("pin\theating_hours\tjournalled_hours\tduty_cycle\tswitches")
+        for pin, (on_time, covered, switches) in sorted(duty(start, end).items()):
+            cycle = on_time / covered if covered else 0.0
+            print(f"{pin}\t{on_time / 3600:.2f}\t{covered / 3600:.2f}\t{cycle:.1%}\t{switches}")
@@ -0,0 +1,385 @@
+#!/bin/python3
+
+# Heater statistics from thermostat2.py logs.
+#
+# Streams the logs (plain or .gz, rotated ones included) in CHUNK_SIZE
+# blocks and folds each block into per-day totals straight away, so memory
+# stays the same however many years of logs there are. logging's line
+# layout is fixed up to the message, so each block is taken apart as one
+# NumPy byte array: line starts, then the message offset from the level,
+# then the bytes at that offset compared against these lines:
+#
+#   [<zone>: ]Heating is turned ON/OFF           relay transitions
+#   [<zone>: ]STATE REPORT: ... Outdoor temperature: <f>°F
+#   [<zone>: ]Heating is disabled due to high outdoor temperature
+#   Age of temperature data: <s> seconds
+#   Error reading temperature from <file>: Temperature data is too old
+#
+# Lines without a zone prefix, from before zones, count as the main zone.
+# Log timestamps are local time and are bucketed as written. Only the
+# rare lines (transitions, stale data errors) are handled one at a time.
+#
+# Prints per day and zone: heater hours, duty cycle, heat cycles started
+# and cycles per hour, then per day: mean outdoor temperature, heating
+# degree days, stale-data incidents, the oldest data age seen and outdoor
+# disable warnings, then how heater hours track degree days.
+#
+# Usage: heaterlogstats.py [log file or directory ...]
+#        defaults to HEATER_LOG_FILE and its rotations
+
+import glob
+import gzip
+import os
+import sys
+import time
+import numpy as np
+from dotenv import load_dotenv
+
+# Bytes read per block
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Days from 1970 covered by the per-day totals
+MAX_DAYS = 130 * 366
+
+# Heating degree day base, °F
+HDD_BASE = 65.0
+
+# Same as thermostat2.DATA_EXPIRATION_TIME, seconds
+DATA_EXPIRATION_TIME = 60 * 60 * 3
+
+# Stale data errors for the same file closer together than this (seconds)
+# are one incident
+STALE_INCIDENT_GAP = 30 * 60
+
+# Log lines are "YYYY-MM-DD HH:MM:SS,mmm - LEVEL - [zone: ]message"
+STAMP_WIDTH = 19
+LEVEL_OFFSET = 26
+MESSAGE_OFFSET = np.zeros(256, dtype=np.int64)
+for level in (b'DEBUG', b'INFO', b'WARNING', b'ERROR', b'CRITICAL'):
+    MESSAGE_OFFSET[level[0]] = LEVEL_OFFSET + len(level) + len(b' - ')
+# Longest zone name prefix looked for
+ZONE_WIDTH = 24
+
+AGE = b'Age of temperature data: '
+TURNED = b'Heating is turned O'
+STATE_REPORT = b'STATE REPORT: Heating is: '
+OUTDOOR = b'Outdoor temperature: '
+OUTDOOR_DISABLED = b'Heating is disabled due to high outdoor'
+STALE = b'Error reading temperature from '
+TOO_OLD = b': Temperature data is too old'
+
+# Bytes that can be part of a number, and how many are looked at
+NUMBER_BYTES = np.zeros(256, dtype=bool)
+NUMBER_BYTES[np.frombuffer(b'0123456789.-+e', dtype=np.uint8)] = True
+NUMBER_WIDTH = 16
+
+# Zero bytes after each block so windows near its end stay in range
+PADDING = bytes(128)
+
+
+def log_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                file = os.path.join(path, name)
+                if os.path.isfile(file):
+                    yield file
+        else:
+            yield path
+
+
+def open_log(file):
+    if file.endswith('.gz'):
+        return gzip.open(file, 'rb')
+    return open(file, 'rb')
+
+
+# Whole lines from a log, CHUNK_SIZE bytes or so at a time
+def read_chunks(file):
+    with open_log(file) as log_file:
+        carry = b''
+        while True:
+            block = log_file.read(CHUNK_SIZE)
+            if not block:
+                break
+            block = carry + block
+            cut = block.rfind(b'\n') + 1
+            carry = block[cut:]
+            if cut:
+                yield block[:cut]
+        if carry:
+            yield carry + b'\n'
+
+
+# width bytes from each position in pos, one row per position
+def gather(buf, pos, width):
+    return buf[pos[:, None] + np.arange(width)]
+
+
+# Whether literal starts at each position. One byte at a time over the
+# positions still matching, most drop out on the first.
+def has_literal(buf, pos, literal):
+    candidates = np.flatnonzero(buf[pos] == literal[0])
+    for i, byte in enumerate(literal[1:], 1):
+        candidates = candidates[buf[pos[candidates] + i] == byte]
+        if len(candidates) == 0:
+            break
+    found = np.zeros(len(pos), dtype=bool)
+    found[candidates] = True
+    return found
+
+
+# Numbers starting at each position, NaN where there isn't one
+def parse_numbers(buf, pos):
+    window = gather(buf, pos, NUMBER_WIDTH)
+    inside = np.logical_and.accumulate(NUMBER_BYTES[window], axis=1)
+    window[~inside] = 0
+    text = window.view(f'S{NUMBER_WIDTH}').ravel()
+    values = np.full(len(pos), np.nan)
+    try:
+        values[inside[:, 0]] = text[inside[:, 0]].astype(np.float64)
+    except ValueError:
+        # Something like "1.2.3" in the block, go one at a time
+        for i in np.flatnonzero(inside[:, 0]):
+            try:
+                values[i] = float(text[i])
+            except ValueError:
+                pass
+    return values
+
+
+# "YYYY-MM-DD HH:MM:SS" stamps at the line starts to seconds since 1970 in
+# local wall time
+def parse_stamps(buf, starts):
+    def field(start, width):
+        value = np.zeros(len(starts), dtype=np.int64)
+        for i in range(start, start + width):
+            value = value * 10 + buf[starts + i] - ord('0')
+        return value
+
+    months = (field(0, 4) - 1970) * 12 + field(5, 2) - 1
+    days = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + field(8, 2) - 1
+    return days * 86400 + field(11, 2) * 3600 + field(14, 2) * 60 + field(17, 2)
+
+
+class Zone:
+    """Per-day heater totals for one zone, built from its transitions"""
+
+    def __init__(self):
+        self.on_seconds = np.zeros(MAX_DAYS)
+        self.starts = np.zeros(MAX_DAYS, dtype=np.int64)
+        self.hourly_starts = np.zeros(24, dtype=np.int64)
+        # Last transition seen, carried from one block to the next
+        self.last_time = None
+        self.last_on = False
+
+    # times ascending, on a bool array of the same length
+    def add(self, times, on):
+        if self.last_time is not None:
+            times = np.concatenate(([self.last_time], times))
+            on = np.concatenate(([self.last_on], on))
+            previous = on[:-1]
+            current = on[1:]
+            started = current & ~previous
+        else:
+            previous = on[:-1]
+            started = np.concatenate(([on[0]], on[1:] & ~previous))
+            current = on
+
+        start_times = times[-len(current):][started]
+        np.add.at(self.starts, start_times // 86400, 1)
+        np.add.at(self.hourly_starts, start_times % 86400 // 3600, 1)
+
+        # Each ON interval runs until the next transition. Those within one
+        # day are added in one go, the few across midnight are split.
+        begin = times[:-1][on[:-1]]
+        end = times[1:][on[:-1]]
+        same_day = begin // 86400 == end // 86400
+        np.add.at(self.on_seconds, begin[same_day] // 86400, end[same_day] - begin[same_day])
+        for b, e in zip(begin[~same_day], end[~same_day]):
+            while b // 86400 != e // 86400:
+                midnight = (b // 86400 + 1) * 86400
+                self.on_seconds[b // 86400] += midnight - b
+                b = midnight
+            self.on_seconds[b // 86400] += e - b
+
+        self.last_time = times[-1]
+        self.last_on = bool(on[-1])
+
+
+class LogStats:
+    def __init__(self):
+        self.zones = {}
+        self.outdoor_sum = np.zeros(MAX_DAYS)
+        self.outdoor_count = np.zeros(MAX_DAYS, dtype=np.int64)
+        self.max_age = np.zeros(MAX_DAYS)
+        self.stale_reads = np.zeros(MAX_DAYS, dtype=np.int64)
+        self.stale_incidents = np.zeros(MAX_DAYS, dtype=np.int64)
+        self.outdoor_disabled = np.zeros(MAX_DAYS, dtype=np.int64)
+        self.seen = np.zeros(MAX_DAYS, dtype=bool)
+        self.last_stale = {}
+        self.lines = 0
+
+    def add_chunk(self, chunk):
+        buf = np.frombuffer(chunk + PADDING, dtype=np.uint8)
+        ends = np.flatnonzero(buf[:len(chunk)] == ord('\n'))
+        starts = np.concatenate(([0], ends[:-1] + 1))
+        self.lines += len(ends)
+
+        logged = (
+            (ends - starts > LEVEL_OFFSET + 8)
+            & (buf[starts + STAMP_WIDTH] == ord(','))
+            & (buf[starts + LEVEL_OFFSET - 2] == ord('-'))
+        )
+        starts = starts[logged]
+        ends = ends[logged]
+        message = starts + MESSAGE_OFFSET[buf[starts + LEVEL_OFFSET]]
+        if len(starts) == 0:
+            return
+
+        # Where the message continues after a "<zone>: " prefix, if it has
+        # one: the first ": " in the message, if it is close enough. Lines
+        # after the last colon get the end of the block, which is padding.
+        colons = np.append(np.flatnonzero(buf[:len(chunk)] == ord(':')), len(chunk))
+        colon = colons[np.searchsorted(colons, message)]
+        zoned = (colon > message) & (colon - message < ZONE_WIDTH) & (buf[colon + 1] == ord(' '))
+        after_zone = colon + 2
+
+        # Times of some of the lines, counting their days as covered by the log
+        def times_of(lines):
+            times = parse_stamps(buf, starts[lines])
+            self.seen[times // 86400] = True
+            return times
+
+        # Lines starting with literal, with or without a zone prefix.
+        # Returns the line numbers and where literal starts in each.
+        def lines_with(literal, zone=True):
+            plain = has_literal(buf, message, literal)
+            if not zone:
+                return np.flatnonzero(plain), message[plain]
+            prefixed = ~plain & zoned
+            check = np.flatnonzero(prefixed)
+            prefixed[check] = has_literal(buf, after_zone[check], literal)
+            found = plain | prefixed
+            return np.flatnonzero(found), np.where(plain, message, after_zone)[found]
+
+        lines, pos = lines_with(TURNED)
+        if len(lines):
+            times = times_of(lines)
+            on = buf[pos + len(TURNED)] == ord('N')
+            names = [chunk[m:p - 2] if p != m else b'main' for m, p in zip(message[lines].tolist(), pos.tolist())]
+            for name in set(names):
+                use = np.array([n == name for n in names])
+                self.zones.setdefault(name.decode(errors='replace'), Zone()).add(times[use], on[use])
+
+        lines, pos = lines_with(STATE_REPORT)
+        if len(lines):
+            # "ON, Indoor temperature: 65.0°F, Outdoor temperature: 30.0°F"
+            window = gather(buf, pos + len(STATE_REPORT), 48)
+            offset = np.argmax((window[:, :-1] == OUTDOOR[0]) & (window[:, 1:] == OUTDOOR[1]), axis=1)
+            outdoor_pos = pos + len(STATE_REPORT) + offset
+            ok = has_literal(buf, outdoor_pos, OUTDOOR)
+            values = parse_numbers(buf, outdoor_pos[ok] + len(OUTDOOR))
+            days = times_of(lines[ok])[~np.isnan(values)] // 86400
+            np.add.at(self.outdoor_sum, days, values[~np.isnan(values)])
+            np.add.at(self.outdoor_count, days, 1)
+
+        lines, pos = lines_with(AGE, zone=False)
+        if len(lines):
+            values = parse_numbers(buf, pos + len(AGE))
+            days = times_of(lines)[~np.isnan(values)] // 86400
+            values = values[~np.isnan(values)]
+            np.maximum.at(self.max_age, days, values)
+            np.add.at(self.stale_reads, days, values > DATA_EXPIRATION_TIME)
+
+        lines, pos = lines_with(OUTDOOR_DISABLED)
+        if len(lines):
+            np.add.at(self.outdoor_disabled, times_of(lines) // 86400, 1)
+
+        lines, pos = lines_with(STALE, zone=False)
+        if len(lines):
+            times = times_of(lines)
+            for t, p, end in zip(times.tolist(), pos.tolist(), ends[lines].tolist()):
+                file, found, _ = chunk[p + len(STALE):end].partition(TOO_OLD)
+                if not found:
+                    continue
+                last = self.last_stale.get(file)
+                if last is None or t - last > STALE_INCIDENT_GAP:
+                    self.stale_incidents[t // 86400] += 1
+                self.last_stale[file] = t
+
+    def report(self):
+        days = np.flatnonzero(self.seen)
+        if len(days) == 0:
+            print("No thermostat2 log lines found")
+            return
+        dates = days.astype('datetime64[D]')
+
+        print("date\tzone\theater_hours\tduty_cycle\tcycles\tcycles_per_hour")
+        heater_hours = np.zeros(len(days))
+        for name, zone in sorted(self.zones.items()):
+            hours = zone.on_seconds[days] / 3600
+            heater_hours += hours
+            for date, h, cycles in zip(dates, hours, zone.starts[days]):
+                print(f"{date}\t{name}\t{h:.2f}\t{h / 24:.1%}\t{cycles}\t{cycles / 24:.2f}")
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            outdoor_mean = self.outdoor_sum[days] / self.outdoor_count[days]
+        hdd = np.maximum(0.0, HDD_BASE - outdoor_mean)
+
+        print()
+        print("date\toutdoor_mean\thdd\tstale_incidents\tstale_reads\tmax_data_age_hours\toutdoor_disabled")
+        for i, date in enumerate(dates):
+            day = days[i]
+            mean = f"{outdoor_mean[i]:.1f}" if self.outdoor_count[day] else ""
+            degree_days = f"{hdd[i]:.1f}" if self.outdoor_count[day] else ""
+            print(f"{date}\t{mean}\t{degree_days}\t{self.stale_incidents[day]}\t{self.stale_reads[day]}\t{self.max_age[day] / 3600:.2f}\t{self.outdoor_disabled[day]}")
+
+        print()
+        for name, zone in sorted(self.zones.items()):
+            total = zone.on_seconds[days].sum() / 3600
+            profile = zone.hourly_starts / len(days)
+            busiest = int(np.argmax(profile))
+            print(f"{name}: {total:.1f} heater hours over {len(days)} days, {zone.starts[days].sum()} cycles, most starts at {busiest:02d}:00 ({profile[busiest]:.2f}/day)")
+        print(f"Stale data: {self.stale_incidents[days].sum()} incidents, {self.stale_reads[days].sum()} stale reads")
+
+        # Heater hours against degree days, over days that heated at all
+        use = (self.outdoor_count[days] > 0) & (heater_hours > 0)
+        if use.sum() >= 3 and np.ptp(hdd[use]) > 0:
+            r = np.corrcoef(hdd[use], heater_hours[use])[0, 1]
+            slope, intercept = np.polyfit(hdd[use], heater_hours[use], 1)
+            print(f"Heater hours vs HDD (base {HDD_BASE:g}°F) over {use.sum()} days: r={r:.2f}, {slope:.2f} h per degree day + {intercept:.2f} h")
+        else:
+            print("Not enough heating days with outdoor data to correlate with degree days")
+
+
+## MAIN ##
+if __name__ == "__main__":
+    load_dotenv()
+
+    paths = sys.argv[1:]
+    if not paths:
+        logfile = os.getenv("HEATER_LOG_FILE")
+        if not logfile:
+            print("Usage: python heaterlogstats.py [log file or directory ...], or set HEATER_LOG_FILE")
+            sys.exit(1)
+        paths = glob.glob(f'{logfile}*')
+
+    # Oldest first, so transitions and stale incidents carry over from one
+    # file to the next in order
+    files = sorted(log_files(paths), key=os.path.getmtime)
+
+    started = time.monotonic()
+    stats = LogStats()
+    size = 0
+    for file in files:
+        try:
+            for chunk in read_chunks(file):
+                size += len(chunk)
+                stats.add_chunk(chunk)
+        except (OSError, EOFError) as e:
+            print(f"Error reading {file}: {e}")
+    elapsed = time.monotonic() - started
+
+    stats.report()
+    print(f"{len(files)} files, {size / 1e6:.0f} MB, {stats.lines} lines in {elapsed:.1f}s")
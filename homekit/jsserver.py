@@ -3,7 +3,12 @@
 import time
 import signal
 import os
+import json
+import sys
+import re
 import logging
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -14,6 +19,10 @@ from pyhap.const import (CATEGORY_FAN,
                          CATEGORY_HEATER,
                          CATEGORY_SENSOR)
 
+# fswatch.py is shared with the ingest scripts one level up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fswatch
+
 # Load environment variables from .env file
 load_dotenv('../.env')
 
@@ -21,15 +30,113 @@ load_dotenv('../.env')
 # Where all input files are placed
 output_file_path = os.getenv("OUTPUT_FILE_PATH")
 hk_switch_file_path = f'{output_file_path}/{os.getenv("HK_SWITCH_OUTPUT_FILE")}'
-mdw_output_file_path = f'{output_file_path}/{os.getenv("MDW_OUTPUT_FILE")}'
-main_output_file_path = f'{output_file_path}/{os.getenv("MAIN_OUTPUT_FILE")}'
-george_output_file_path = f'{output_file_path}/{os.getenv("GEORGE_OUTPUT_FILE")}'
-mbr_output_file_path = f'{output_file_path}/{os.getenv("MBR_OUTPUT_FILE")}'
 bb_heater_state_file_path = f'{output_file_path}/{os.getenv("HEATER_STATE_FILE")}'
 
 
 logging.basicConfig(level=logging.INFO, format="[%(module)s] %(message)s")
 
+# State file reads run off the HAP event loop and give up after this long
+STATE_READ_TIMEOUT = 5.0
+
+# Event loop lag: sampled this often, warned about above LOOP_LAG_WARN,
+# summarized in the log every LOOP_LAG_REPORT_INTERVAL (all seconds)
+LOOP_LAG_INTERVAL = 2.0
+LOOP_LAG_WARN = 0.25
+LOOP_LAG_REPORT_INTERVAL = 600
+
+# Temperatures (°C) closer than this to the last value sent are not sent
+TEMP_DEADBAND_C = 0.1
+
+# What a sensor can report: HomeKit service, characteristic, and the
+# smallest change worth sending (see publish)
+SENSOR_READINGS = {
+    'temperature': ('TemperatureSensor', 'CurrentTemperature', TEMP_DEADBAND_C),
+    'humidity': ('HumiditySensor', 'CurrentRelativeHumidity', 1.0),
+    'air_quality': ('AirQualitySensor', 'AirQuality', 0),
+}
+
+# Bridged sensors. file is relative to OUTPUT_FILE_PATH, format picks the
+# parser in STATE_FORMATS, readings are keys of SENSOR_READINGS. aid is
+# fixed so adding or reordering sensors doesn't re-number the others for
+# paired controllers. Can be replaced by a JSON file, see load_sensors().
+# Pod pressure is left out, HomeKit has no characteristic for it.
+SENSORS = [
+    {'name': 'Temp Main', 'aid': 3, 'file': os.getenv("MAIN_OUTPUT_FILE"),
+     'format': 'temperature', 'readings': ['temperature']},
+    {'name': 'Temp MBR', 'aid': 4, 'file': os.getenv("MBR_OUTPUT_FILE"),
+     'format': 'temperature', 'readings': ['temperature']},
+    {'name': 'Temp George', 'aid': 5, 'file': os.getenv("GEORGE_OUTPUT_FILE"),
+     'format': 'temperature', 'readings': ['temperature']},
+    {'name': 'Temp MDW', 'aid': 7, 'file': os.getenv("MDW_OUTPUT_FILE"),
+     'format': 'temperature', 'readings': ['temperature']},
+    {'name': 'Outdoor Pod', 'aid': 8, 'file': os.getenv("OUTDOOR_WX_OUTPUT_FILE"),
+     'format': 'pod', 'readings': ['temperature', 'humidity', 'air_quality']},
+    {'name': 'George Pod', 'aid': 9, 'file': os.getenv("GEORGE_WX_OUTPUT_FILE"),
+     'format': 'pod', 'readings': ['temperature', 'humidity', 'air_quality']},
+    {'name': 'MBR Pod', 'aid': 10, 'file': os.getenv("MBR_WX_OUTPUT_FILE"),
+     'format': 'pod', 'readings': ['temperature', 'humidity', 'air_quality']},
+]
+
+# Heater daemon state line written by thermostat2.py
+BB_STATE_PATTERN = re.compile(
+    r'(?P<timestamp>[\w, ]+ \d{2}:\d{2}:\d{2} -\d{4})\t'
+    r'Daemon is: (?P<daemon_status>\w+), '
+    r'Heating is: (?P<heating_status>\w+), '
+    r'Indoor temperature: (?P<indoor_temp>[\d.]+)°F, '
+    r'Outdoor temperature: (?P<outdoor_temp>[\d.]+)°F, '
+    r'Setpoint temperature: (?P<setpoint_temp>[\d.]+)°F')
+
+
+class StateFileCache:
+    """Parsed state files, re-parsed only when the file changes on disk
+
+    A file is considered unchanged while its (st_ino, st_mtime_ns, st_size)
+    stays the same, so a poll of an unchanged file is a single stat().
+    The writers replace files with an atomic rename, which always changes
+    the inode.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def read(self, path, parser):
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            logging.error(f"Error reading {path}: {e}")
+            return None
+
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        cached = self.entries.get((path, parser))
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        value = parser(path)
+        self.entries[(path, parser)] = (key, value)
+        return value
+
+
+state_files = StateFileCache()
+
+
+# Every set_value() can fan out an event to all paired controllers, so only
+# send a value that differs from the last one sent by at least deadband
+# (exact comparison when deadband is 0)
+last_published = {}
+publish_counts = {'sent': 0, 'suppressed': 0}
+
+
+def publish(char, value, deadband=0):
+    last = last_published.get(char)
+    if last is not None and (value == last or abs(value - last) < deadband):
+        publish_counts['suppressed'] += 1
+        return False
+
+    char.set_value(value)
+    last_published[char] = value
+    publish_counts['sent'] += 1
+    return True
+
 class LightBulb(Accessory):
     """lightbulb to signal home/away to my stuff"""
 
@@ -50,75 +157,35 @@ class LightBulb(Accessory):
         write_state(value)
 
 
-class TemperatureSensorMain(Accessory):
-    """Temperature sensor - main living room"""
-
-    category = CATEGORY_SENSOR
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-        serv_temp = self.add_preload_service('TemperatureSensor')
-        self.char_temp = serv_temp.configure_char('CurrentTemperature')
-
-    @Accessory.run_at_interval(30)
-    async def run(self):
-        t = read_temperature_from_file(main_output_file_path)
-        if t is not None:
-            self.char_temp.set_value(t)
-
-class TemperatureSensorMBR(Accessory):
-    """Temperature sensor - MBR"""
-
-    category = CATEGORY_SENSOR
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+class SensorAccessory(Accessory):
+    """Read-only sensor built from a SENSORS entry
 
-        serv_temp = self.add_preload_service('TemperatureSensor')
-        self.char_temp = serv_temp.configure_char('CurrentTemperature')
-
-    @Accessory.run_at_interval(30)
-    async def run(self):
-        t = read_temperature_from_file(mbr_output_file_path)
-        if t is not None:
-            self.char_temp.set_value(t)
-
-class TemperatureSensorGeorge(Accessory):
-    """Temperature sensor - George"""
+    One HomeKit service per reading, all fed from the same state file.
+    """
 
     category = CATEGORY_SENSOR
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-        serv_temp = self.add_preload_service('TemperatureSensor')
-        self.char_temp = serv_temp.configure_char('CurrentTemperature')
-
-    @Accessory.run_at_interval(30)
-    async def run(self):
-        t = read_temperature_from_file(george_output_file_path)
-        if t is not None:
-            self.char_temp.set_value(t)
-    
-class TemperatureSensorMDW(Accessory):
-    """Sensor - Midway METAR"""
+    def __init__(self, driver, config):
+        super().__init__(driver, config['name'], aid=config['aid'])
+        self.state_file = f'{output_file_path}/{config["file"]}'
+        self.parser = STATE_FORMATS[config['format']]
 
-    category = CATEGORY_SENSOR
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+        self.chars = {}
+        for reading in config['readings']:
+            service, char, deadband = SENSOR_READINGS[reading]
+            serv = self.add_preload_service(service)
+            self.chars[reading] = (serv.configure_char(char), deadband)
 
-        serv_temp = self.add_preload_service('TemperatureSensor',
-                                             chars=['CurrentRelativeHumidity'])
-        self.char_temp = serv_temp.configure_char('CurrentTemperature')
-        self.char_humid = serv_temp.configure_char('CurrentRelativeHumidity')
+    def read_state(self):
+        return state_files.read(self.state_file, self.parser)
 
-    @Accessory.run_at_interval(30)
-    async def run(self):
-        t = read_temperature_from_file(mdw_output_file_path)
-        if t is not None:
-            self.char_temp.set_value(t)
+    def update(self, state):
+        if not state:
+            return
+        for reading, (char, deadband) in self.chars.items():
+            value = state.get(reading)
+            if value is not None:
+                publish(char, value, deadband)
 
 
 class BBHeater(Accessory):
@@ -127,6 +194,7 @@ class BBHeater(Accessory):
     # https://developer.apple.com/documentation/homekit/hmservicetypeheatercooler/
 
     category = CATEGORY_HEATER
+    state_file = bb_heater_state_file_path
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -146,7 +214,7 @@ class BBHeater(Accessory):
         # "Auto": 0,
         # "Cool": 2,
         # "Heat": 1
-        self.char_target_state.set_value(1)
+        publish(self.char_target_state, 1)
 
         self.char_target_state.override_properties(properties={'Permissions': ["pr","ev"]}) # read only
         # default self.char_heat_state.override_properties(properties={'Permissions': "pr"}) # read only
@@ -156,11 +224,13 @@ class BBHeater(Accessory):
 
 
 
-    @Accessory.run_at_interval(10)
-    async def run(self):
+    def read_state(self):
+        return state_files.read(bb_heater_state_file_path, read_bb_from_file)
+
+    def update(self, t):
 
         # Always a heater
-        self.char_target_state.set_value(1)
+        publish(self.char_target_state, 1)
 
         # https://developer.apple.com/documentation/homekit/hmcharacteristicvaluecurrentheatercoolerstate
         # "ValidValues": {
@@ -169,45 +239,169 @@ class BBHeater(Accessory):
         # "Idle": 1,
         # "Inactive": 0
 
-        t = read_bb_from_file(bb_heater_state_file_path)
         if t:
 
             # print(t)
 
             # If the daemon isn't running, set to inactive
             if t['daemon_status'].casefold() != 'running'.casefold():
-                self.char_heat_state.set_value(0)
-                self.char_active.set_value(0)
+                publish(self.char_heat_state, 0)
+                publish(self.char_active, 0)
                 # print(f'Set: HS: 0, Active: 0')
             
             else: # demon is running
                 if t['heating_status'].casefold() == 'on'.casefold():
-                    self.char_heat_state.set_value(2)
-                    self.char_active.set_value(1)
+                    publish(self.char_heat_state, 2)
+                    publish(self.char_active, 1)
                     # print(f'Set: HS: 2, Active: 1')
                 else:
-                    self.char_heat_state.set_value(1)
-                    self.char_active.set_value(1)
+                    publish(self.char_heat_state, 1)
+                    publish(self.char_active, 1)
                     # print(f'Set: HS: 1, Active: 1')
 
-            self.char_temp.set_value(f_to_c(float(t['indoor_temp'])))
-            self.char_setpoint.set_value(f_to_c(float(t['setpoint_temp'])))
+            publish(self.char_temp, f_to_c(float(t['indoor_temp'])), TEMP_DEADBAND_C)
+            publish(self.char_setpoint, f_to_c(float(t['setpoint_temp'])), TEMP_DEADBAND_C)
             # print(f"Set: { f_to_c(float(t['indoor_temp'])) } and { f_to_c(float(t['setpoint_temp'])) }")
         
         else:
             print("Error updating BB ")
 
 
+class StateBridge(Bridge):
+    """Bridge that pushes state file changes to its accessories
+
+    Accessories with a state_file attribute are refreshed as soon as the file
+    is renamed into place, using one inotify watch on OUTPUT_FILE_PATH read
+    from the HAP event loop, rather than a polling timer per accessory.
+
+    The file itself is read by the accessory's read_state() on a small
+    thread pool, with a timeout, so a slow SD card can't stall pairing or
+    controller requests. The result is handed to update() back on the loop.
+    Event loop lag is sampled and logged.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.watcher = None
+        self.watched = {}
+        self.io_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='stateio')
+        self.reading = set()
+        self.dirty = set()
+        self.lag_task = None
+
+    async def run(self):
+        self.watched = {}
+        for acc in self.accessories.values():
+            if getattr(acc, 'state_file', None):
+                self.watched.setdefault(acc.state_file, []).append(acc)
+
+        self.watcher = fswatch.Watcher()
+        for path in self.watched:
+            # The writers always replace the file with a rename
+            self.watcher.add(path, fswatch.IN_REPLACED)
+        asyncio.get_running_loop().add_reader(self.watcher.fileno(), self.on_state_change)
+        self.lag_task = asyncio.ensure_future(self.monitor_loop_lag())
+
+        # Pick up whatever is there now
+        self.dispatch(self.watched)
+        await super().run()
+
+    def on_state_change(self):
+        try:
+            self.dispatch(self.watcher.read(timeout=0))
+        except OSError as e:
+            logging.error(f"Error reading inotify events: {e}")
+
+    def dispatch(self, paths):
+        for path in paths:
+            for acc in self.watched.get(path, []):
+                if acc in self.reading:
+                    # Read again once the one in flight is done
+                    self.dirty.add(acc)
+                else:
+                    self.reading.add(acc)
+                    asyncio.ensure_future(self.refresh(acc))
+
+    async def refresh(self, acc):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                self.dirty.discard(acc)
+                try:
+                    state = await asyncio.wait_for(
+                        loop.run_in_executor(self.io_pool, acc.read_state),
+                        STATE_READ_TIMEOUT)
+                    acc.update(state)
+                except asyncio.TimeoutError:
+                    logging.error(f"Timed out reading {acc.state_file} for {acc.display_name}")
+                except Exception as e:
+                    logging.error(f"Error updating {acc.display_name}: {e}")
+                if acc not in self.dirty:
+                    break
+        finally:
+            self.reading.discard(acc)
+
+    async def monitor_loop_lag(self):
+        loop = asyncio.get_running_loop()
+        worst = 0.0
+        total = 0.0
+        samples = 0
+        next_report = loop.time() + LOOP_LAG_REPORT_INTERVAL
+
+        while True:
+            expected = loop.time() + LOOP_LAG_INTERVAL
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = max(0.0, loop.time() - expected)
+
+            worst = max(worst, lag)
+            total += lag
+            samples += 1
+            if lag > LOOP_LAG_WARN:
+                logging.warning(f"Event loop lagged {lag * 1000:.0f} ms")
+
+            if loop.time() >= next_report:
+                logging.info(f"Event loop lag: avg {total / samples * 1000:.1f} ms, max {worst * 1000:.1f} ms over {samples} samples")
+                logging.info(f"Characteristic updates: {publish_counts['sent']} sent, {publish_counts['suppressed']} suppressed")
+                worst = total = 0.0
+                samples = 0
+                next_report = loop.time() + LOOP_LAG_REPORT_INTERVAL
+
+    async def stop(self):
+        if self.lag_task is not None:
+            self.lag_task.cancel()
+            self.lag_task = None
+        if self.watcher is not None:
+            asyncio.get_running_loop().remove_reader(self.watcher.fileno())
+            self.watcher.close()
+            self.watcher = None
+        self.io_pool.shutdown(wait=False)
+        await super().stop()
+
+
 def get_bridge(driver):
-    bridge = Bridge(driver, 'Bridge')
-    bridge.add_accessory(LightBulb(driver, 'Lightbulb'))
-    bridge.add_accessory(TemperatureSensorMain(driver, 'Temp Main'))
-    bridge.add_accessory(TemperatureSensorMBR(driver, 'Temp MBR'))
-    bridge.add_accessory(TemperatureSensorGeorge(driver, 'Temp George'))
-    bridge.add_accessory(BBHeater(driver, 'Main BB Heater'))
-    bridge.add_accessory(TemperatureSensorMDW(driver, 'Temp MDW'))
+    bridge = StateBridge(driver, 'Bridge')
+    bridge.add_accessory(LightBulb(driver, 'Lightbulb', aid=2))
+    bridge.add_accessory(BBHeater(driver, 'Main BB Heater', aid=6))
+    for config in load_sensors():
+        bridge.add_accessory(SensorAccessory(driver, config))
     return bridge
 
+
+# SENSORS, or the list in HK_SENSORS_FILE (JSON, same keys) if set
+def load_sensors():
+    sensors_file = os.getenv("HK_SENSORS_FILE")
+    if not sensors_file:
+        return SENSORS
+    with open(sensors_file, 'r') as file:
+        sensors = json.load(file)
+    for config in sensors:
+        if config['format'] not in STATE_FORMATS:
+            raise ValueError(f"{config['name']}: unknown format {config['format']}")
+        for reading in config['readings']:
+            if reading not in SENSOR_READINGS:
+                raise ValueError(f"{config['name']}: unknown reading {reading}")
+    return sensors
+
 def quit_handler(signum, frame):
     logging.info(f"Signal {signum} received. Cleaning-up and exiting")
     driver.signal_handler(signum, frame)
@@ -259,20 +453,55 @@ def read_temperature_from_file(file):
         logging.error(f"Error reading temperature from {file}: {e}")
         return None
 
-import re
+
+def read_temperature_state(file):
+    t = read_temperature_from_file(file)
+    return None if t is None else {'temperature': t}
+
+
+# BME680 IAQ index -> HomeKit AirQuality (1 excellent .. 5 poor)
+def iaq_to_air_quality(iaq):
+    for limit, level in ((50, 1), (100, 2), (150, 3), (200, 4)):
+        if iaq <= limit:
+            return level
+    return 5
+
+
+# Arduino pod file written by updatearduino.py:
+#   <timestamp>\t<thing name>
+#   {<variable_name>,<last_value>,<value_updated_at>}
+#   ...
+def read_pod_from_file(file_path):
+    try:
+        props = {}
+        with open(file_path, 'r') as file:
+            file.readline()
+            for line in file:
+                line = line.strip()
+                if not (line.startswith('{') and line.endswith('}')):
+                    continue
+                name, _, rest = line[1:-1].partition(',')
+                value = rest.rpartition(',')[0]
+                props[name] = value
+
+        state = {}
+        if props.get('temperature'):
+            state['temperature'] = f_to_c(float(props['temperature']))
+        if props.get('humidity'):
+            state['humidity'] = min(100.0, max(0.0, float(props['humidity'])))
+        if props.get('airQuality'):
+            state['air_quality'] = iaq_to_air_quality(float(props['airQuality']))
+        return state
+    except Exception as e:
+        logging.error(f"Error reading pod state from {file_path}: {e}")
+        return None
 
 
 def read_bb_from_file(file_path):
     try:
         with open(file_path, 'r') as file:
             line = file.readline()
-            pattern = (r'(?P<timestamp>[\w, ]+ \d{2}:\d{2}:\d{2} -\d{4})\t'
-                       r'Daemon is: (?P<daemon_status>\w+), '
-                       r'Heating is: (?P<heating_status>\w+), '
-                       r'Indoor temperature: (?P<indoor_temp>[\d.]+)°F, '
-                       r'Outdoor temperature: (?P<outdoor_temp>[\d.]+)°F, '
-                       r'Setpoint temperature: (?P<setpoint_temp>[\d.]+)°F')
-            match = re.match(pattern, line)
+            match = BB_STATE_PATTERN.match(line)
             if match:
                 return match.groupdict()
             else:
@@ -282,6 +511,13 @@ def read_bb_from_file(file_path):
         return None
 
 
+# Parsers for SensorAccessory state files, by SENSORS format
+STATE_FORMATS = {
+    'temperature': read_temperature_state,
+    'pod': read_pod_from_file,
+}
+
+
 ### MAIN ###
 
 ## Signal handlers
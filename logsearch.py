@@ -0,0 +1,36 @@
+#!/bin/python3
+
+import os
+
+# Read the log backwards this much at a time
+BLOCK_SIZE = 64 * 1024
+
+
+# Matches of a compiled bytes regex in a log file, newest first.
+# Reads fixed-size blocks from the end of the file and runs the regex on
+# the raw buffer, so memory stays the same no matter how big the log gets
+# and a caller that stops at the first usable match reads no further.
+# Yields re.Match objects (bytes groups).
+def find_matches_backwards(file_path, pattern, block_size=BLOCK_SIZE):
+    with open(file_path, 'rb') as log_file:
+        pos = os.fstat(log_file.fileno()).st_size
+        carry = b''
+
+        while pos > 0:
+            read_size = min(block_size, pos)
+            pos -= read_size
+            log_file.seek(pos)
+            buf = log_file.read(read_size) + carry
+
+            if pos > 0:
+                # The first line in the block may have started in the
+                # previous one, keep it for the next pass
+                cut = buf.find(b'\n') + 1
+                if cut == 0:
+                    carry = buf
+                    continue
+                carry = buf[:cut]
+                buf = buf[cut:]
+
+            yield from reversed(list(pattern.finditer(buf)))
+
@@ -0,0 +1,337 @@
+#!/bin/python3
+
+# Durable local outbox for measurements.
+#
+# Ingest writes land here first, in an append-only spool under
+# OUTPUT_FILE_PATH/outbox, and are drained to Postgres in large batches by
+# flush(), either at the end of a cron run or from a background flusher
+# thread in a daemon. If the database is down the readings wait on disk
+# instead of being lost. Replaying a segment twice is harmless because the
+# measurements tables ignore a second row for the same station and hour.
+#
+# Layout:
+#   current            segment being appended to
+#   seg-<ns>.log       sealed segments, drained oldest first
+#   quarantine/        rows the database rejected outright (bad values,
+#                      constraint violations), one file per segment they
+#                      came from, so they don't hold up everything after
+#                      them. Written once the segment is fully drained, and
+#                      capped at MAX_QUARANTINE_BYTES, oldest dropped first.
+#                      "outbox.py requeue" puts them back once fixed.
+#   append.lock        held while appending or sealing
+#   flush.lock         held by whoever is draining
+#
+# Each record is one line: crc32 of the payload in hex, a tab, then the
+# payload as compact JSON {"t": table, "r": row}. A torn or corrupt line
+# fails the CRC check and is skipped.
+#
+# Usage: outbox.py flush | status | requeue
+
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+from contextlib import contextmanager, suppress
+from dotenv import load_dotenv
+
+import envdb
+
+# Seal the current segment once it is this big
+SEGMENT_SIZE = 256 * 1024
+# Most disk the spool may use, oldest sealed segments are dropped beyond this
+MAX_OUTBOX_BYTES = 64 * 1024 * 1024
+# Same for quarantine/, on top of MAX_OUTBOX_BYTES
+MAX_QUARANTINE_BYTES = 16 * 1024 * 1024
+# Rows per write_measurements() call when draining
+FLUSH_BATCH_SIZE = 5000
+# Background flusher retries at least this often (seconds)
+FLUSH_INTERVAL = 60
+# How long stop_flusher() waits for a flush in progress (seconds)
+FLUSH_STOP_TIMEOUT = 15
+
+# Set to wake the background flusher early
+flush_requested = threading.Event()
+# Set to make the background flusher exit
+flush_stop = threading.Event()
+# The background flusher thread, if started
+flusher = None
+
+
+def outbox_dir():
+    return os.getenv("OUTBOX_PATH") or f'{os.getenv("OUTPUT_FILE_PATH")}/outbox'
+
+
+@contextmanager
+def locked(name, blocking=True):
+    os.makedirs(outbox_dir(), exist_ok=True)
+    with open(os.path.join(outbox_dir(), name), 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def encode(table, row):
+    payload = json.dumps({"t": table, "r": row}, separators=(',', ':'), default=str)
+    return f"{zlib.crc32(payload.encode()):08x}\t{payload}\n"
+
+
+def decode(line):
+    crc, sep, payload = line.rstrip('\n').partition('\t')
+    if not sep or not line.endswith('\n'):
+        return None
+    try:
+        if int(crc, 16) != zlib.crc32(payload.encode()):
+            return None
+        record = json.loads(payload)
+        return record["t"], record["r"]
+    except (ValueError, KeyError):
+        return None
+
+
+def quarantine_dir():
+    return os.path.join(outbox_dir(), 'quarantine')
+
+
+# seg-*.log files in directory, oldest first
+def segments_in(directory):
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(os.path.join(directory, n) for n in names if n.startswith('seg-') and n.endswith('.log'))
+
+
+def sealed_segments():
+    return segments_in(outbox_dir())
+
+
+# Drop the oldest segments in directory until they add up to at most limit
+# bytes. A segment that disappears meanwhile (drained) is just skipped.
+def drop_oldest(directory, limit, what):
+    segments = segments_in(directory)
+    sizes = {}
+    for segment in segments:
+        with suppress(FileNotFoundError):
+            sizes[segment] = os.path.getsize(segment)
+    total = sum(sizes.values())
+    while segments and total > limit:
+        oldest = segments.pop(0)
+        print(f"{what} over {limit} bytes, dropping {oldest}")
+        with suppress(FileNotFoundError):
+            os.remove(oldest)
+        total -= sizes.get(oldest, 0)
+
+
+# Caller holds append.lock
+def seal_current():
+    current = os.path.join(outbox_dir(), 'current')
+    try:
+        if os.path.getsize(current) == 0:
+            return
+    except FileNotFoundError:
+        return
+    os.rename(current, os.path.join(outbox_dir(), f'seg-{time.time_ns():020d}.log'))
+    enforce_limit()
+
+
+# Caller holds append.lock. flush() may be draining the oldest segment
+# under flush.lock, it copes with the segment going away.
+def enforce_limit():
+    drop_oldest(outbox_dir(), MAX_OUTBOX_BYTES, "Outbox")
+
+
+# Append rows for table to the spool and fsync. Returns once they are on disk.
+def write(table, rows):
+    if not rows:
+        return True
+    if table not in envdb.TABLES:
+        raise ValueError(f"Unknown measurements table: {table}")
+
+    try:
+        with locked('append.lock'):
+            current = os.path.join(outbox_dir(), 'current')
+            with open(current, 'ab+') as segment:
+                # Don't let a torn record from a crash swallow this one
+                if segment.seek(0, os.SEEK_END) > 0:
+                    segment.seek(-1, os.SEEK_END)
+                    if segment.read(1) != b'\n':
+                        segment.write(b'\n')
+                segment.write(''.join(encode(table, row) for row in rows).encode())
+                segment.flush()
+                os.fsync(segment.fileno())
+                size = segment.tell()
+            if size >= SEGMENT_SIZE:
+                seal_current()
+    except Exception as e:
+        print(f"Error writing to outbox {outbox_dir()}: {e}")
+        return False
+
+    flush_requested.set()
+    return True
+
+
+# Write the (table, row) pairs the database rejected from segment source
+# as its quarantine file, replacing any earlier one, so a segment drained
+# twice doesn't quarantine its rows twice. Caller holds flush.lock.
+def quarantine(records, source):
+    os.makedirs(quarantine_dir(), exist_ok=True)
+    path = os.path.join(quarantine_dir(), os.path.basename(source))
+    with open(f'{path}.tmp', 'w') as rejected:
+        rejected.write(''.join(encode(table, row) for table, row in records))
+        rejected.flush()
+        os.fsync(rejected.fileno())
+    os.rename(f'{path}.tmp', path)
+    print(f"Quarantined {len(records)} rejected rows in {path}")
+    drop_oldest(quarantine_dir(), MAX_QUARANTINE_BYTES, "Quarantine")
+
+
+# Send one segment to the database. Returns False if a batch couldn't be
+# sent for now, in which case the segment is kept and retried on the next
+# flush. A batch the database rejects is sent again one row at a time, the
+# good rows go in and the bad ones are quarantined once the whole segment
+# is through.
+def drain_segment(path):
+    batches = {}
+    rejected = []
+
+    def send(table):
+        rows = batches[table]
+        batches[table] = []
+        try:
+            return envdb.write_measurements(table, rows)
+        except envdb.RejectedRows:
+            pass
+
+        for row in rows:
+            try:
+                if not envdb.write_measurements(table, [row]):
+                    return False
+            except envdb.RejectedRows:
+                rejected.append((table, row))
+        return True
+
+    with open(path, 'r', errors='replace') as segment:
+        for line in segment:
+            record = decode(line)
+            if record is None:
+                print(f"Skipping damaged outbox record in {path}")
+                continue
+            table, row = record
+            batches.setdefault(table, []).append(row)
+            if len(batches[table]) >= FLUSH_BATCH_SIZE and not send(table):
+                return False
+
+    for table in batches:
+        if batches[table] and not send(table):
+            return False
+    if rejected:
+        quarantine(rejected, path)
+    return True
+
+
+# Drain everything spooled so far. Only one flusher runs at a time, a second
+# caller returns straight away. Returns the number of segments sent.
+def flush():
+    with locked('flush.lock', blocking=False) as have_lock:
+        if not have_lock:
+            return 0
+
+        with locked('append.lock'):
+            seal_current()
+
+        sent = 0
+        for path in sealed_segments():
+            # enforce_limit() can drop a segment before or while it drains
+            try:
+                if not drain_segment(path):
+                    break
+            except FileNotFoundError:
+                continue
+            with suppress(FileNotFoundError):
+                os.remove(path)
+            sent += 1
+        return sent
+
+
+# Background flusher for daemons: drains after every write() and at least
+# every FLUSH_INTERVAL seconds so a backlog clears once Postgres is back.
+def start_flusher():
+    global flusher
+
+    def run():
+        while True:
+            flush_requested.wait(FLUSH_INTERVAL)
+            flush_requested.clear()
+            if flush_stop.is_set():
+                return
+            try:
+                flush()
+            except Exception as e:
+                print(f"Outbox flush failed: {e}")
+
+    flush_stop.clear()
+    flusher = threading.Thread(target=run, name='outbox-flusher', daemon=True)
+    flusher.start()
+    return flusher
+
+
+# Stop the background flusher, waiting up to timeout seconds for a flush in
+# progress to finish. Anything not sent stays spooled. Returns False if the
+# flusher is still running (and may still be using the database).
+def stop_flusher(timeout=FLUSH_STOP_TIMEOUT):
+    if flusher is None:
+        return True
+    flush_stop.set()
+    flush_requested.set()
+    flusher.join(timeout)
+    return not flusher.is_alive()
+
+
+# Put quarantined rows back in the outbox, e.g. after fixing the schema or
+# the rows. Rows that are still rejected go back to quarantine.
+def requeue():
+    with locked('flush.lock'), locked('append.lock'):
+        paths = segments_in(quarantine_dir())
+        for path in paths:
+            # New name, the segment it came from may still be waiting
+            os.rename(path, os.path.join(outbox_dir(), f'seg-{time.time_ns():020d}.log'))
+    print(f"{len(paths)} quarantined segments requeued")
+
+
+def status():
+    segments = sealed_segments()
+    current = os.path.join(outbox_dir(), 'current')
+    pending = sum(os.path.getsize(s) for s in segments)
+    if os.path.exists(current):
+        pending += os.path.getsize(current)
+    print(f"{outbox_dir()}: {len(segments)} sealed segments, {pending} bytes pending")
+    rejected = segments_in(quarantine_dir())
+    if rejected:
+        size = sum(os.path.getsize(path) for path in rejected)
+        print(f"{quarantine_dir()}: {len(rejected)} files, {size} bytes of rejected rows")
+
+
+## MAIN ##
+if __name__ == "__main__":
+    load_dotenv()
+
+    if len(sys.argv) != 2 or sys.argv[1] not in ("flush", "status", "requeue"):
+        print("Usage: python outbox.py flush | status | requeue")
+        sys.exit(1)
+
+    if sys.argv[1] == "requeue":
+        requeue()
+
+    if sys.argv[1] == "flush":
+        print(f"{flush()} segments sent")
+        envdb.close()
+    status()
@@ -0,0 +1,45 @@
+import math
+
+import pytest
+
+import heaterjournal
+
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch):
+    monkeypatch.setenv("HEATER_JOURNAL_PATH", str(tmp_path))
+    journal = heaterjournal.Journal()
+    yield journal
+    journal.close()
+
+
+def record(time, **fields):
+    values = dict(
+        time=time, kind=heaterjournal.DECISION, pin=23, branch=heaterjournal.BELOW_BAND,
+        heating_wanted=True, heating_on=False, home=True,
+        indoor_temperature=65.0, outdoor_temperature=None, setpoint_temperature=69.5,
+        hysteresis=1.0, start_hour=9, end_hour=23, outdoor_disable_point=45.0,
+    )
+    values.update(fields)
+    return heaterjournal.Record(**values)
+
+
+@pytest.mark.parametrize("fields", [
+    {"start_hour": 9.5},
+    {"end_hour": None},
+    {"pin": "23"},
+    {"hysteresis": "1.0"},
+    {"end_hour": 300},
+])
+def test_bad_record_is_dropped_not_raised(journal, fields):
+    journal.append(record(1000.0, **fields))
+    journal.append(record(1001.0))
+    journal.close()
+    assert [r.time for r in heaterjournal.read_range(0, math.inf)] == [1001.0]
+
+
+def test_round_trip(journal):
+    written = record(1000.0, outdoor_disable_point=None)
+    journal.append(written)
+    journal.close()
+    assert list(heaterjournal.read_range(0, math.inf)) == [written]
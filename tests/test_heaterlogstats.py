@@ -0,0 +1,33 @@
+import heaterlogstats
+
+LOG = (
+    "2024-11-01 10:00:00,123 - INFO - Heating is turned ON. Indoor temperature: 68.0°F, Desired temperature: 69.5°F\n"
+    "2024-11-01 10:30:00,456 - INFO - george: Heating is turned ON. Indoor temperature: 68.0°F, Desired temperature: 69.5°F\n"
+    "2024-11-01 11:00:00,789 - INFO - Heating is turned OFF. Indoor temperature: 70.5°F, Desired temperature: 69.5°F\n"
+    "2024-11-01 11:15:00,012 - INFO - george: Heating is turned OFF. Indoor temperature: 70.5°F, Desired temperature: 69.5°F\n"
+    "2024-11-01 11:20:00,345 - INFO - GPIO Cleanup\n"
+)
+
+
+def stats_of(path):
+    stats = heaterlogstats.LogStats()
+    for chunk in heaterlogstats.read_chunks(str(path)):
+        stats.add_chunk(chunk)
+    return stats
+
+
+def test_log_ending_in_line_without_colon(tmp_path):
+    log = tmp_path / "heater.log"
+    log.write_text(LOG, encoding="utf-8")
+    stats = stats_of(log)
+    assert stats.lines == 5
+    assert stats.zones["main"].on_seconds.sum() == 3600
+    assert stats.zones["george"].on_seconds.sum() == 45 * 60
+
+
+def test_log_without_trailing_newline(tmp_path):
+    log = tmp_path / "heater.log"
+    log.write_text(LOG.rstrip("\n"), encoding="utf-8")
+    stats = stats_of(log)
+    assert stats.zones["main"].starts.sum() == 1
+    assert stats.zones["george"].on_seconds.sum() == 45 * 60
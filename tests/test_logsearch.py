@@ -0,0 +1,40 @@
+import re
+
+import pytest
+
+import updateindoortemp
+from logsearch import find_matches_backwards
+
+LINE = "{stamp}  Main Omnistat RC-2000: Indoor temp is {temp}, humidity is 40, HVAC Command: none\n"
+
+
+def write_log(path, *readings):
+    lines = []
+    for i, (stamp, temp) in enumerate(readings):
+        lines.append(f"noise line {i} with nothing of interest\n" * 3)
+        lines.append(LINE.format(stamp=stamp, temp=temp))
+    path.write_text("".join(lines) + "GPIO Cleanup\n")
+
+
+@pytest.mark.parametrize("block_size", [7, 64, 65536])
+def test_matches_newest_first(tmp_path, block_size):
+    log = tmp_path / "omnistat.log"
+    log.write_text("".join(f"reading {i}\nother\n" for i in range(50)))
+    found = [int(m.group(1)) for m in find_matches_backwards(str(log), re.compile(rb"reading (\d+)"), block_size)]
+    assert found == list(range(49, -1, -1))
+
+
+def test_corrupt_newest_timestamp_falls_back(tmp_path):
+    log = tmp_path / "omnistat.log"
+    output = tmp_path / "indoortemp"
+    write_log(log, ("01/06/25 09:00:00 AM", 66), ("01/06/25 09:05:00 AM", 67), ("13/45/25 99:05:00 PM", 99))
+    temp, stamp = updateindoortemp.extract_indoor_temperature_from_log(str(log), str(output))
+    assert temp == 67.0
+    assert stamp.startswith("Mon, 06 Jan 2025 09:05:00 ")
+    assert output.read_text().startswith("67.0\t")
+
+
+def test_no_usable_line(tmp_path):
+    log = tmp_path / "omnistat.log"
+    write_log(log, ("13/45/25 99:05:00 PM", 99))
+    assert updateindoortemp.extract_indoor_temperature_from_log(str(log), str(tmp_path / "out")) is None
@@ -0,0 +1,113 @@
+import os
+
+import pytest
+
+import envdb
+import outbox
+
+
+@pytest.fixture
+def spool(tmp_path, monkeypatch):
+    monkeypatch.setenv("OUTBOX_PATH", str(tmp_path))
+    return tmp_path
+
+
+def row(station, temperature):
+    return {"recorded_at": "2025-01-06T10:00:00", "station_id": station, "temperature_f": temperature}
+
+
+def quarantined():
+    records = []
+    for path in outbox.segments_in(outbox.quarantine_dir()):
+        with open(path) as rejected:
+            records += [outbox.decode(line) for line in rejected]
+    return records
+
+
+class Database:
+    """Stands in for envdb.write_measurements: rejects rows with a None
+    temperature, and fails transiently while down is set"""
+
+    def __init__(self):
+        self.rows = []
+        self.down = False
+
+    def write_measurements(self, table, rows):
+        if any(r["temperature_f"] is None for r in rows):
+            raise envdb.RejectedRows("bad row")
+        if self.down:
+            return False
+        self.rows += rows
+        return True
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = Database()
+    monkeypatch.setattr(envdb, "write_measurements", database.write_measurements)
+    return database
+
+
+def test_rejected_rows_quarantined_once(spool, database, monkeypatch):
+    outbox.write("measurements", [row(1, 30.0), row(2, None)])
+    outbox.write("indoor_measurements", [row(3, 65.0)])
+
+    # The rejected measurements row is found, then indoor_measurements fails
+    calls = []
+
+    def flaky(table, rows):
+        calls.append(table)
+        if table == "indoor_measurements" and calls.count(table) == 1:
+            return False
+        return database.write_measurements(table, rows)
+
+    monkeypatch.setattr(envdb, "write_measurements", flaky)
+    assert outbox.flush() == 0
+    assert quarantined() == []
+    assert outbox.flush() == 1
+    assert outbox.flush() == 0
+    assert quarantined() == [("measurements", row(2, None))]
+    assert outbox.sealed_segments() == []
+
+
+def test_flush_survives_segment_dropped_while_draining(spool, database, monkeypatch):
+    outbox.write("measurements", [row(1, 30.0)])
+    drain = outbox.drain_segment
+
+    def dropped_meanwhile(path):
+        ok = drain(path)
+        os.remove(path)
+        return ok
+
+    monkeypatch.setattr(outbox, "drain_segment", dropped_meanwhile)
+    assert outbox.flush() == 1
+    assert database.rows == [row(1, 30.0)]
+
+
+def test_flush_skips_segment_dropped_before_draining(spool, database, monkeypatch):
+    outbox.write("measurements", [row(1, 30.0)])
+    with outbox.locked('append.lock'):
+        outbox.seal_current()
+    (path,) = outbox.sealed_segments()
+    monkeypatch.setattr(outbox, "sealed_segments", lambda: [path + ".gone", path])
+    assert outbox.flush() == 1
+    assert database.rows == [row(1, 30.0)]
+
+
+def test_quarantine_capped(spool, database, monkeypatch):
+    monkeypatch.setattr(outbox, "MAX_QUARANTINE_BYTES", 300)
+    for station in range(4):
+        outbox.write("measurements", [row(station, None)] * 2)
+        outbox.flush()
+    kept = outbox.segments_in(outbox.quarantine_dir())
+    assert 0 < len(kept) < 4
+    assert sum(os.path.getsize(p) for p in kept) <= 300
+    assert quarantined()[-1] == ("measurements", row(3, None))
+
+
+def test_requeue(spool, database):
+    outbox.write("measurements", [row(1, None)])
+    outbox.flush()
+    outbox.requeue()
+    assert quarantined() == []
+    assert len(outbox.sealed_segments()) == 1
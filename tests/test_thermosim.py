@@ -0,0 +1,57 @@
+import logging
+
+import pytest
+
+import thermosim
+import thermostat2
+
+
+@pytest.fixture(autouse=True)
+def quiet():
+    logging.disable(logging.CRITICAL)
+    yield
+    logging.disable(logging.NOTSET)
+
+
+@pytest.fixture(scope="module")
+def four_weeks():
+    logging.disable(logging.CRITICAL)
+    return thermosim.simulate(28, 69.5)
+
+
+def test_room_settles_in_band(four_weeks):
+    # Cold only while warming up after nights and away hours
+    assert four_weeks["cold_minutes"] < 0.15 * four_weeks["occupied_minutes"]
+    assert four_weeks["hot_minutes"] < 0.01 * four_weeks["occupied_minutes"]
+    assert abs(four_weeks["final_room_temperature"] - 69.5) <= thermostat2.DEFAULT_HYSTERESIS + thermosim.COMFORT_MARGIN
+
+
+def test_no_heat_when_away_or_outside_hours(four_weeks):
+    assert four_weeks["heat_away_minutes"] == 0
+    assert four_weeks["heat_outside_hours_minutes"] == 0
+
+
+def test_no_heat_on_stale_data(four_weeks):
+    # The weekly sensor outages do let the data expire
+    assert four_weeks["no_data_minutes"] > 0
+    assert four_weeks["heat_stale_minutes"] == 0
+
+
+def test_relay_respects_minimum_times(monkeypatch):
+    # Longer than a heating cycle and off the tick, so changes have to wait
+    monkeypatch.setattr(thermostat2, "RELAY_MIN_ON_TIME", 1230)
+    monkeypatch.setattr(thermostat2, "RELAY_MIN_OFF_TIME", 1530)
+    stats = thermosim.simulate(7, 69.5)
+    assert stats["held_relay_changes"] > 0
+    assert stats["short_relay_switches"] == 0
+
+
+def test_checks_catch_a_broken_controller(monkeypatch):
+    def always_heat(self):
+        self.turn_on_heating(thermostat2.heaterjournal.BELOW_BAND)
+
+    monkeypatch.setattr(thermostat2.Thermostat, "control_temperature", always_heat)
+    stats = thermosim.simulate(7, 69.5)
+    assert stats["heat_away_minutes"] > 0
+    assert stats["heat_outside_hours_minutes"] > 0
+    assert stats["heat_stale_minutes"] > 0
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+import thermostat2
+
+ZONE = {
+    "name": "george",
+    "pin": 24,
+    "sensor_file": "georgetemp",
+    "setpoint": 68,
+    "start_hour": 9,
+    "end_hour": 23,
+    "hysteresis": 1.0,
+    "outdoor_disable_point": 45,
+}
+
+
+@pytest.fixture
+def zones_file(tmp_path, monkeypatch):
+    path = tmp_path / "zones.json"
+    monkeypatch.setenv("THERMOSTAT_ZONES_FILE", str(path))
+    monkeypatch.setenv("HEATER_STATE_FILE", "heaterstate")
+
+    def write(zones):
+        path.write_text(json.dumps(zones))
+        return path
+    return write
+
+
+def test_defaults_filled_in(zones_file):
+    zone = {key: ZONE[key] for key in ("name", "pin", "sensor_file", "setpoint")}
+    zones_file([zone])
+    (loaded,) = thermostat2.load_zones([])
+    assert loaded["start_hour"] == thermostat2.DEFAULT_START_HOUR
+    assert loaded["state_file"] == "heaterstate-george"
+
+
+@pytest.mark.parametrize("key", ["pin", "sensor_file", "setpoint"])
+def test_missing_key(zones_file, key):
+    zones_file([{k: v for k, v in ZONE.items() if k != key}])
+    with pytest.raises(ValueError, match=f"george: {key} is missing"):
+        thermostat2.load_zones([])
+
+
+@pytest.mark.parametrize("key, value", [
+    ("pin", "24"),
+    ("pin", True),
+    ("pin", -1),
+    ("sensor_file", 5),
+    ("start_hour", 9.0),
+    ("end_hour", 25),
+    ("hysteresis", "1"),
+    ("hysteresis", -0.5),
+    ("outdoor_disable_point", [45]),
+])
+def test_bad_value(zones_file, key, value):
+    zones_file([dict(ZONE, **{key: value})])
+    with pytest.raises(ValueError, match=f"george: {key}"):
+        thermostat2.load_zones([])
+
+
+@pytest.mark.parametrize("zones", [{}, [], ["george"], [{"pin": 24}]])
+def test_bad_layout(zones_file, zones):
+    zones_file(zones)
+    with pytest.raises(ValueError):
+        thermostat2.load_zones([])
+
+
+def test_duplicate_pin(zones_file):
+    zones_file([ZONE, dict(ZONE, name="main")])
+    with pytest.raises(ValueError, match="main: name and pin must be unique"):
+        thermostat2.load_zones([])
@@ -0,0 +1,27 @@
+import pytest
+
+import updateenvironmental
+
+
+@pytest.fixture
+def log(tmp_path, monkeypatch):
+    path = tmp_path / "omnistat.log"
+    monkeypatch.setattr(updateenvironmental, "tstat_input_file_path", str(path))
+    monkeypatch.setattr(updateenvironmental, "tstat_offset_file_path", str(tmp_path / "tstat.offset"))
+    return path
+
+
+def test_reads_only_new_lines(log):
+    log.write_text("one\ntwo\n")
+    assert updateenvironmental.read_new_log_lines() == ["one", "two"]
+    with open(log, "a") as appended:
+        appended.write("three\nfour")
+    assert updateenvironmental.read_new_log_lines() == ["three"]
+
+
+def test_unreadable_log_is_reported_not_raised(log, capsys):
+    # Opening a directory fails with an OSError other than FileNotFoundError,
+    # like a PermissionError during rotation would
+    log.mkdir()
+    assert updateenvironmental.read_new_log_lines() == []
+    assert "Error reading log file" in capsys.readouterr().out
@@ -0,0 +1,292 @@
+#!/bin/python3
+
+# Offline simulation of the thermostat2.py control loop.
+#
+# Runs the real Thermostat decisions (hysteresis, operating hours, outdoor
+# cut-off, home/away, stale sensor data, relay minimum on/off times) against
+# a simple room model, with a fake relay and a clock that jumps from one
+# event to the next, so weeks of control run in a second or two on any
+# machine. Everything is seeded, the same arguments always give the same
+# numbers, which makes it a benchmark and a regression check for changes to
+# the control loop.
+#
+# Besides comfort and heater use it counts what the control loop must never
+# do: switch the relay inside its minimum on/off time, or heat while away,
+# outside operating hours or on stale indoor data. All of those should be 0.
+#
+# Usage: thermosim.py [days] [setpoint_temperature]
+
+import math
+import random
+import sys
+import time
+import logging
+from datetime import datetime, timedelta
+
+import thermostat2
+
+# Room model: the heater adds HEAT_RATE °F/hour, the room loses LOSS_RATE of
+# the indoor/outdoor difference per hour. A reasonably insulated house, it
+# loses about 7°F over a night off and the heater wins that back within the
+# hour, so cold minutes are the warm-ups after nights and away hours.
+HEAT_RATE = 9.0
+LOSS_RATE = 0.02
+
+# Outdoor temperature: mean, daily swing and a slower weather swing, °F.
+# A heating season, only the warmest afternoons reach the outdoor cut-off.
+OUTDOOR_MEAN = 30.0
+OUTDOOR_DAILY_SWING = 8.0
+OUTDOOR_WEATHER_SWING = 8.0
+OUTDOOR_WEATHER_DAYS = 9
+
+# The indoor sensor reports this often (seconds), METAR once an hour
+INDOOR_SENSOR_INTERVAL = 300
+OUTDOOR_SENSOR_INTERVAL = 3600
+SENSOR_NOISE = 0.1
+
+# Away on weekdays between these hours
+AWAY_HOURS = (10, 16)
+
+# One indoor sensor outage a week, long enough for the data to expire
+OUTAGE_HOURS = 5
+
+# Degrees below setpoint - hysteresis counted as too cold
+COMFORT_MARGIN = 1.0
+
+SEED = 1
+
+
+class SimClock:
+    """Clock for Thermostat that only moves when advanced"""
+
+    def __init__(self, start):
+        self.start = start
+        self.elapsed = 0.0
+
+    def now(self):
+        return self.start + timedelta(seconds=self.elapsed)
+
+    def time(self):
+        return self.start.timestamp() + self.elapsed
+
+    def monotonic(self):
+        return self.elapsed
+
+    def advance_to(self, elapsed):
+        self.elapsed = elapsed
+
+
+class SimHeater:
+    """Relay with no hardware behind it, counts switches and the ones made
+    inside the relay's minimum on/off time"""
+
+    def __init__(self, clock, pin=0):
+        self.clock = clock
+        self.pin = pin
+        self.status = False
+        self.switches = 0
+        self.short_switches = 0
+        self.last_switch = None
+
+    def switch(self, status):
+        if status == self.status:
+            return
+        now = self.clock.monotonic()
+        held = thermostat2.RELAY_MIN_ON_TIME if self.status else thermostat2.RELAY_MIN_OFF_TIME
+        if self.last_switch is not None and now - self.last_switch < held:
+            self.short_switches += 1
+        self.last_switch = now
+        self.switches += 1
+        self.status = status
+
+    def turnon(self):
+        self.switch(True)
+
+    def turnoff(self):
+        self.switch(False)
+
+    def is_on(self):
+        return self.status
+
+
+class SimSensor:
+    """Reports a value every interval seconds, except during outages"""
+
+    def __init__(self, interval, rng, outages=()):
+        self.interval = interval
+        self.rng = rng
+        self.outages = outages
+        self.value = None
+        self.timestamp = None
+        self.next_report = 0.0
+
+    def sample(self, clock, value):
+        if clock.elapsed < self.next_report:
+            return
+        self.next_report = clock.elapsed + self.interval
+        if any(start <= clock.elapsed < end for start, end in self.outages):
+            return
+        self.value = round(value + self.rng.gauss(0, SENSOR_NOISE), 1)
+        self.timestamp = clock.now()
+
+    # Whether the last report is older than the daemon accepts
+    def stale(self, clock):
+        return (
+            self.timestamp is None
+            or (clock.now() - self.timestamp).total_seconds() > thermostat2.DATA_EXPIRATION_TIME
+        )
+
+    # Same checks the daemon applies to a reading from a file
+    def reading(self, clock):
+        if self.value is None:
+            return None
+        try:
+            return thermostat2.check_temperature(self.value, self.timestamp, clock.now())
+        except ValueError:
+            return None
+
+
+class SimInputs:
+    """Stands in for SharedInputs"""
+
+    def __init__(self):
+        self.outdoor_temperature = None
+        self.home = True
+
+
+class SimThermostat(thermostat2.Thermostat):
+    """Thermostat that reads its indoor temperature from a SimSensor"""
+
+    def __init__(self, sensor, *args, **kwargs):
+        self.sensor = sensor
+        super().__init__(*args, **kwargs)
+
+    def get_indoor_temperature(self):
+        self.indoor_temperature = self.sensor.reading(self.clock)
+
+
+def outdoor_temperature(when):
+    hour = when.hour + when.minute / 60
+    day = when.timestamp() / 86400
+    return (
+        OUTDOOR_MEAN
+        + OUTDOOR_DAILY_SWING * math.sin(2 * math.pi * (hour - 9) / 24)
+        + OUTDOOR_WEATHER_SWING * math.sin(2 * math.pi * day / OUTDOOR_WEATHER_DAYS)
+    )
+
+
+def is_home(when):
+    return when.weekday() >= 5 or not (AWAY_HOURS[0] <= when.hour < AWAY_HOURS[1])
+
+
+def simulate(days, setpoint, start_hour=thermostat2.DEFAULT_START_HOUR,
+             end_hour=thermostat2.DEFAULT_END_HOUR, hysteresis=thermostat2.DEFAULT_HYSTERESIS,
+             outdoor_disable_point=thermostat2.OUTDOOR_TEMP_DISABLE_POINT, seed=SEED):
+    rng = random.Random(seed)
+    clock = SimClock(datetime(2025, 1, 6))
+    end = days * 86400.0
+    step = thermostat2.LOOP_SLEEP_TIME
+
+    outages = []
+    for week in range(int(days // 7) + 1):
+        start = week * 7 * 86400 + rng.uniform(0, 6 * 86400)
+        outages.append((start, start + OUTAGE_HOURS * 3600))
+
+    room = 60.0
+    indoor = SimSensor(INDOOR_SENSOR_INTERVAL, rng, outages)
+    outdoor = SimSensor(OUTDOOR_SENSOR_INTERVAL, rng)
+    inputs = SimInputs()
+    heater = SimHeater(clock)
+
+    indoor.sample(clock, room)
+    outdoor.sample(clock, outdoor_temperature(clock.now()))
+    inputs.outdoor_temperature = outdoor.reading(clock)
+    thermostat = SimThermostat(
+        indoor, "sim", heater, inputs, None, None,
+        setpoint, start_hour, end_hour, hysteresis, outdoor_disable_point,
+        clock=clock
+    )
+
+    stats = {
+        "ticks": 0,
+        "heater_hours": 0.0,
+        "relay_switches": 0,
+        "occupied_minutes": 0.0,
+        "cold_minutes": 0.0,
+        "hot_minutes": 0.0,
+        "no_data_minutes": 0.0,
+        "held_relay_changes": 0,
+        "short_relay_switches": 0,
+        "heat_away_minutes": 0.0,
+        "heat_outside_hours_minutes": 0.0,
+        "heat_stale_minutes": 0.0,
+    }
+    next_tick = 0.0
+
+    while clock.elapsed < end:
+        due = thermostat.relay_due
+        event = min(next_tick, due) if due is not None else next_tick
+
+        # Room follows the relay up to the next event
+        dt = event - clock.elapsed
+        if dt > 0:
+            hours = dt / 3600
+            gain = HEAT_RATE if heater.status else 0.0
+            room += hours * (gain - LOSS_RATE * (room - outdoor_temperature(clock.now())))
+            in_hours = thermostat.start_hour <= clock.now().hour < thermostat.end_hour
+            if heater.status:
+                stats["heater_hours"] += hours
+                if not inputs.home:
+                    stats["heat_away_minutes"] += dt / 60
+                if not in_hours:
+                    stats["heat_outside_hours_minutes"] += dt / 60
+                if indoor.stale(clock):
+                    stats["heat_stale_minutes"] += dt / 60
+            if in_hours and inputs.home:
+                stats["occupied_minutes"] += dt / 60
+                if room < setpoint - hysteresis - COMFORT_MARGIN:
+                    stats["cold_minutes"] += dt / 60
+                elif room > setpoint + hysteresis + COMFORT_MARGIN:
+                    stats["hot_minutes"] += dt / 60
+            if thermostat.indoor_temperature is None:
+                stats["no_data_minutes"] += dt / 60
+        clock.advance_to(event)
+
+        if event == next_tick:
+            now = clock.now()
+            indoor.sample(clock, room)
+            outdoor.sample(clock, outdoor_temperature(now))
+            inputs.outdoor_temperature = outdoor.reading(clock)
+            inputs.home = is_home(now)
+            thermostat.update_temperature()
+            stats["ticks"] += 1
+            next_tick += step
+        else:
+            stats["held_relay_changes"] += 1
+            thermostat.apply_relay()
+
+    stats["relay_switches"] = heater.switches
+    stats["short_relay_switches"] = heater.short_switches
+    stats["final_room_temperature"] = round(room, 2)
+    return stats
+
+
+## MAIN ##
+if __name__ == "__main__":
+    try:
+        days = float(sys.argv[1]) if len(sys.argv) > 1 else 28
+        setpoint = float(sys.argv[2]) if len(sys.argv) > 2 else 69.5
+    except ValueError:
+        print("Usage: python thermosim.py [days] [setpoint_temperature]")
+        sys.exit(1)
+
+    # The control loop logs every pass, far too much for weeks of simulation
+    logging.disable(logging.CRITICAL)
+
+    started = time.monotonic()
+    stats = simulate(days, setpoint)
+    elapsed = time.monotonic() - started
+
+    for key, value in stats.items():
+        print(f"{key}: {round(value, 2) if isinstance(value, float) else value}")
+    print(f"{days:g} days simulated in {elapsed:.2f}s ({stats['ticks'] / elapsed:.0f} ticks/s)")
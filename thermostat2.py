@@ -1,14 +1,59 @@
 #!/bin/python3
 
+# Baseboard heater thermostat daemon.
+#
+# Usage: thermostat2.py <setpoint_temperature>
+#        drives the main zone (BBPIN, MAIN_OUTPUT_FILE, HEATER_STATE_FILE)
+#
+#    or: THERMOSTAT_ZONES_FILE=zones.json thermostat2.py
+#        drives every zone listed in the file, a JSON list of
+#          {"name": "george", "pin": 24, "sensor_file": "georgetemp",
+#           "setpoint": 68, "start_hour": 9, "end_hour": 23, "hysteresis": 1.0,
+#           "outdoor_disable_point": 45, "state_file": "heaterstate-george"}
+#        Files are relative to OUTPUT_FILE_PATH. start_hour, end_hour,
+#        hysteresis and outdoor_disable_point default as below, state_file
+#        to HEATER_STATE_FILE-<name>. Hours are whole hours 0-24. The file
+#        is checked in full before any pin is touched.
+#
+# The outdoor temperature and the home/away switch are read once and shared
+# by all zones.
+#
+# Saving the zones file, or SIGHUP (systemctl reload bb-heat), reloads the
+# RELOADABLE settings of each zone in place, without touching the relays.
+# Adding or removing zones, or changing a pin or file, needs a restart.
+#
+# Relay state, last transition and last readings are checkpointed after
+# every pass. On startup a zone whose checkpoint is fresh and agrees with
+# its GPIO pin carries on where it left off instead of switching off.
+# SIGUSR2 exits leaving the relays as they are, for a restart (upgrade)
+# that doesn't drop a running heat cycle.
+#
+# Every control decision and relay transition is appended to the binary
+# journal in heaterjournal.py, see there for reading it back.
+#
+# Importing this module starts nothing, the daemon runs from main(). The
+# relay (Heater) and the clock Thermostat uses can be swapped out, see
+# thermosim.py for running it against a simulated room.
+
+import math
 import time
 import signal
 import sys
 import os
+import json
 import logging
 from datetime import datetime
-import RPi.GPIO as GPIO
 from dotenv import load_dotenv
 
+try:
+    import RPi.GPIO as GPIO
+except (ImportError, RuntimeError):
+    # Not on a Pi, only the simulation can run
+    GPIO = None
+
+import fswatch
+import heaterjournal
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -17,42 +62,223 @@ DEBUG = True  # Enable or disable debug logs
 BBPIN = 23
 
 output_file_path = os.getenv("OUTPUT_FILE_PATH")
-indoor_temp_file_path = f'{output_file_path}/{os.getenv("MAIN_OUTPUT_FILE")}'
 outdoor_temp_file_path = f'{output_file_path}/{os.getenv("MDW_OUTPUT_FILE")}'
-heater_state_file_path = f'{output_file_path}/{os.getenv("HEATER_STATE_FILE")}'
 hk_home_away_file_path = f'{output_file_path}/{os.getenv("HK_SWITCH_OUTPUT_FILE")}'
+checkpoint_file_path = f'{output_file_path}/thermostat.checkpoint'
 logfile = os.getenv("HEATER_LOG_FILE")
 
-LOOP_SLEEP_TIME = 60  # Sleep time in seconds between each loop
+LOOP_SLEEP_TIME = 60  # Safety tick in seconds: re-read everything even if no file changed
 DATA_EXPIRATION_TIME = 60 * 60 * 3  # Data expiration time in seconds (3 hours)
 OUTDOOR_TEMP_DISABLE_POINT = 45  # Disable heating if outdoor temperature is above this value in Fahrenheit
 MIN_TEMP = -20  # Minimum valid temperature in Fahrenheit
 MAX_TEMP = 110  # Maximum valid temperature in Fahrenheit
+RELAY_MIN_ON_TIME = 5  # Seconds the relay stays on before it may switch off
+RELAY_MIN_OFF_TIME = 5  # Seconds the relay stays off before it may switch on
+CHECKPOINT_MAX_AGE = 300  # Checkpoints older than this (seconds) are ignored on startup
+RESTART_EXIT_STATUS = 75  # Exit status after a SIGUSR2 handoff, see bb-heat.service
+
+# Zone defaults
+DEFAULT_START_HOUR = 9
+DEFAULT_END_HOUR = 23
+DEFAULT_HYSTERESIS = 1.0
+
+# Zone settings that can change without a restart
+RELOADABLE = ("setpoint", "start_hour", "end_hour", "hysteresis", "outdoor_disable_point")
+
+# Zone settings and the types each may have, after defaults are filled in
+ZONE_TYPES = {
+    "name": (str,),
+    "pin": (int,),
+    "sensor_file": (str,),
+    "state_file": (str,),
+    "setpoint": (int, float),
+    "start_hour": (int,),
+    "end_hour": (int,),
+    "hysteresis": (int, float),
+    "outdoor_disable_point": (int, float),
+}
+
+
+class SystemClock:
+    """Wall and monotonic time for Thermostat, replaced in simulation"""
+
+    def now(self):
+        return datetime.now()
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+
+system_clock = SystemClock()
+
+
+class FixedRateTicker:
+    """Safety tick every period seconds on the monotonic clock
+
+    Ticks are due at start + n * period, so the time spent in control passes
+    doesn't push later ticks back. When the loop is so busy that the next
+    tick is already due as one starts (an overrun), the missed ticks are
+    skipped rather than run back to back. Pass durations, lateness, overruns
+    and skipped ticks are kept for the state report.
+    """
+
+    def __init__(self, period):
+        self.period = period
+        self.next_tick = time.monotonic()
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.max_late = 0.0
+        self.last_pass = 0.0
+        self.max_pass = 0.0
+
+    def due(self, now):
+        return now >= self.next_tick
+
+    # The tick due at next_tick is starting at now
+    def tick(self, now):
+        late = now - self.next_tick
+        self.max_late = max(self.max_late, late)
+        self.ticks += 1
+        self.next_tick += self.period
+        if now >= self.next_tick:
+            missed = int((now - self.next_tick) // self.period) + 1
+            self.overruns += 1
+            self.skipped += missed
+            self.next_tick += missed * self.period
+            logging.warning(f"Control loop overrun: tick {late:.1f}s late, skipped {missed}")
+
+    # A control pass (tick or not) took duration seconds
+    def record_pass(self, duration):
+        self.last_pass = duration
+        self.max_pass = max(self.max_pass, duration)
+
+    def report(self):
+        return (
+            f"Loop: {self.ticks} ticks of {self.period}s, "
+            f"pass {self.last_pass * 1000:.1f} ms (max {self.max_pass * 1000:.1f} ms), "
+            f"max late {self.max_late * 1000:.1f} ms, "
+            f"overruns {self.overruns}, skipped ticks {self.skipped}"
+        )
+
 
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    filename=logfile,
-    filemode='a'
-)
+class SharedInputs:
+    """Readings every zone uses: outdoor temperature and home/away"""
+
+    def __init__(self, clock=system_clock):
+        self.clock = clock
+        self.update()
+
+    # Re-read the files in changed, or both if changed is None. Returns True
+    # if anything was re-read.
+    def update(self, changed=None):
+        updated = False
+        if changed is None or outdoor_temp_file_path in changed:
+            self.outdoor_temperature = read_temperature_from_file(outdoor_temp_file_path, self.clock)
+            updated = True
+        if changed is None or hk_home_away_file_path in changed:
+            self.home = read_home_away()
+            updated = True
+        return updated
 
 
 class Thermostat:
-    def __init__(self, tstat, setpoint_temperature, start_hour, end_hour, hysteresis):
+    """One heater zone
+
+    tstat is the relay: anything with a pin, a status, turnon(), turnoff()
+    and is_on(), normally a Heater. clock supplies now(), time() and
+    monotonic(), normally the system clock. journal, if given, is a
+    heaterjournal.Journal to record decisions and transitions in.
+    """
+
+    def __init__(self, name, tstat, inputs, indoor_temp_file_path, state_file_path,
+                 setpoint_temperature, start_hour, end_hour, hysteresis,
+                 outdoor_disable_point=OUTDOOR_TEMP_DISABLE_POINT, checkpoint=None,
+                 clock=system_clock, journal=None):
         logging.debug(
-            f"Initializing Thermostat with setpoint_temperature={setpoint_temperature}°F, start_hour={start_hour}, end_hour={end_hour}, hysteresis={hysteresis}°F"
+            f"Initializing Thermostat {name} with setpoint_temperature={setpoint_temperature}°F, start_hour={start_hour}, end_hour={end_hour}, hysteresis={hysteresis}°F, outdoor_disable_point={outdoor_disable_point}°F"
         )
+        self.name = name
+        self.clock = clock
+        self.journal = journal
+        self.branch = heaterjournal.STARTUP
+        self.inputs = inputs
+        self.indoor_temp_file_path = indoor_temp_file_path
+        self.state_file_path = state_file_path
         self.get_indoor_temperature()
-        self.get_outdoor_temperature()
         self.setpoint_temperature = setpoint_temperature
         self.start_hour = start_hour
         self.end_hour = end_hour
-        self.heating_on = False
         self.hysteresis = hysteresis
+        self.outdoor_disable_point = outdoor_disable_point
         self.tstat = tstat
-        self.tstat.turnoff()
-        time.sleep(5)
+        if not self.restore(checkpoint):
+            self.tstat.turnoff()
+            self.heating_on = False
+            self.heating_wanted = False
+            self.last_transition = self.clock.time()
+            self.relay_ready_at = self.clock.monotonic() + RELAY_MIN_OFF_TIME
+
+    # Take over relay state from this zone's checkpoint entry, if it matches
+    # what the GPIO pin is actually doing. Returns False if it can't, and
+    # the caller starts from off as usual.
+    def restore(self, checkpoint):
+        if checkpoint is None or checkpoint.get("pin") != self.tstat.pin:
+            return False
+
+        pin_on = self.tstat.is_on()
+        if pin_on != checkpoint["heating_on"]:
+            logging.warning(
+                f"{self.name}: checkpoint says heating {'ON' if checkpoint['heating_on'] else 'OFF'} but the relay is {'ON' if pin_on else 'OFF'}, not restoring"
+            )
+            return False
+
+        self.tstat.status = pin_on
+        self.heating_on = pin_on
+        self.heating_wanted = pin_on
+        self.last_transition = checkpoint["last_transition"]
+        hold = RELAY_MIN_ON_TIME if pin_on else RELAY_MIN_OFF_TIME
+        self.relay_ready_at = self.clock.monotonic() + max(0.0, self.last_transition + hold - self.clock.time())
+        logging.info(
+            f"{self.name}: restored from checkpoint, heating {'ON' if pin_on else 'OFF'} since {datetime.fromtimestamp(self.last_transition)}, last indoor temperature {checkpoint.get('indoor_temperature')}°F"
+        )
+        return True
+
+    def checkpoint(self):
+        return {
+            "pin": self.tstat.pin,
+            "heating_on": self.heating_on,
+            "last_transition": self.last_transition,
+            "indoor_temperature": self.indoor_temperature,
+            "outdoor_temperature": self.outdoor_temperature,
+            "home": self.home,
+        }
+
+    # Apply the RELOADABLE settings from a zone table entry. The relay is
+    # left alone until the next control pass.
+    def reconfigure(self, zone):
+        settings = {
+            "setpoint": "setpoint_temperature",
+            "start_hour": "start_hour",
+            "end_hour": "end_hour",
+            "hysteresis": "hysteresis",
+            "outdoor_disable_point": "outdoor_disable_point",
+        }
+        for key, attr in settings.items():
+            if getattr(self, attr) != zone[key]:
+                logging.info(f"{self.name}: {key} changed from {getattr(self, attr)} to {zone[key]}")
+                setattr(self, attr, zone[key])
+
+    @property
+    def outdoor_temperature(self):
+        return self.inputs.outdoor_temperature
+
+    @property
+    def home(self):
+        return self.inputs.home
 
     def report_state(self):
         heating_status = "ON" if self.heating_on else "OFF"
@@ -68,119 +294,170 @@ class Thermostat:
         )
         s = f"STATE REPORT: Heating is: {heating_status}, Indoor temperature: {indoor_temp}, Outdoor temperature: {outdoor_temp}, Setpoint temperature: {self.setpoint_temperature}°F"
         if DEBUG:
-            logging.info(s)
+            logging.info(f"{self.name}: {s}")
         return s[14:] # Remove "STATE REPORT: " prefix
 
-    def update_temperature(self):
-        self.get_indoor_temperature()
-        self.get_outdoor_temperature()
-        if (
-            self.indoor_temperature is not None
-            and self.outdoor_temperature is not None
-        ):
-            self.control_temperature()
+    # Re-read this zone's sensor if it is in changed (always if changed is
+    # None) and run a control pass. Shared readings are updated by the caller.
+    def update_temperature(self, changed=None):
+        if changed is None or self.indoor_temp_file_path in changed:
+            self.get_indoor_temperature()
+        self.control_temperature()
 
     def control_temperature(self):
         if self.indoor_temperature is None or self.outdoor_temperature is None:
-            logging.error("Temperature data is unavailable. Turning off heating.")
-            self.turn_off_heating()
+            logging.error(f"{self.name}: Temperature data is unavailable. Turning off heating.")
+            self.turn_off_heating(heaterjournal.NO_DATA)
             return
         
-        if not read_home_away():
-            logging.info("Home status is not True. Turning off heating.")
-            self.turn_off_heating()
+        if not self.home:
+            logging.info(f"{self.name}: Home status is not True. Turning off heating.")
+            self.turn_off_heating(heaterjournal.AWAY)
             return
 
-        current_hour = datetime.now().hour
+        current_hour = self.clock.now().hour
         if self.start_hour <= current_hour < self.end_hour:
-            if self.outdoor_temperature < OUTDOOR_TEMP_DISABLE_POINT:
+            if self.outdoor_temperature < self.outdoor_disable_point:
                 if self.indoor_temperature < (
                     self.setpoint_temperature - self.hysteresis
                 ):
-                    self.turn_on_heating()
+                    self.turn_on_heating(heaterjournal.BELOW_BAND)
                 elif self.indoor_temperature > (
                     self.setpoint_temperature + self.hysteresis
                 ):
-                    self.turn_off_heating()
+                    self.turn_off_heating(heaterjournal.ABOVE_BAND)
+                else:
+                    self.record(heaterjournal.DECISION, heaterjournal.IN_BAND)
             else:
-                self.turn_off_heating()
+                self.turn_off_heating(heaterjournal.OUTDOOR_DISABLED)
                 if DEBUG:
                     logging.warning(
-                        f"Heating is disabled due to high outdoor temperature: {self.outdoor_temperature:.1f}°F"
+                        f"{self.name}: Heating is disabled due to high outdoor temperature: {self.outdoor_temperature:.1f}°F"
                     )
         else:
-            self.turn_off_heating()
+            self.turn_off_heating(heaterjournal.OUTSIDE_HOURS)
             if DEBUG:
                 logging.warning(
-                    "Heating is disabled due to being outside of operational hours."
+                    f"{self.name}: Heating is disabled due to being outside of operational hours."
                 )
 
-    def turn_on_heating(self):
-        if not self.heating_on:
+    # branch is the heaterjournal branch that decided it
+    def turn_on_heating(self, branch):
+        self.heating_wanted = True
+        self.record(heaterjournal.DECISION, branch)
+        self.apply_relay()
+
+    # force skips the minimum on time, for shutdown only
+    def turn_off_heating(self, branch, force=False):
+        self.heating_wanted = False
+        self.record(heaterjournal.DECISION, branch)
+        self.apply_relay(force)
+
+    # Append a decision (after heating_wanted is set) or transition (after
+    # the relay switched) to the journal
+    def record(self, kind, branch):
+        self.branch = branch
+        if self.journal is None:
+            return
+        self.journal.append(heaterjournal.Record(
+            self.clock.time(), kind, self.tstat.pin, branch,
+            self.heating_wanted, self.heating_on, self.home,
+            self.indoor_temperature, self.outdoor_temperature,
+            self.setpoint_temperature, self.hysteresis,
+            self.start_hour, self.end_hour, self.outdoor_disable_point
+        ))
+
+    # When a relay change is waiting on RELAY_MIN_ON_TIME/RELAY_MIN_OFF_TIME,
+    # the monotonic time it can be made, otherwise None. The main loop calls
+    # apply_relay() then.
+    @property
+    def relay_due(self):
+        if self.heating_wanted == self.heating_on:
+            return None
+        return self.relay_ready_at
+
+    # Switch the relay to heating_wanted unless it changed too recently.
+    # Never blocks, a change that has to wait is left for relay_due.
+    def apply_relay(self, force=False):
+        if self.heating_wanted == self.heating_on:
+            return
+
+        now = self.clock.monotonic()
+        if now < self.relay_ready_at and not force:
+            if DEBUG:
+                logging.debug(f"{self.name}: Relay change held for {self.relay_ready_at - now:.1f}s")
+            return
+
+        indoor_temp = (
+            f"{self.indoor_temperature:.1f}°F"
+            if self.indoor_temperature is not None
+            else "N/A"
+        )
+        if self.heating_wanted:
             if DEBUG:
                 logging.info(
-                    f"Heating is turned ON. Indoor temperature: {self.indoor_temperature:.1f}°F, Desired temperature: {self.setpoint_temperature:.1f}°F"
+                    f"{self.name}: Heating is turned ON. Indoor temperature: {indoor_temp}, Desired temperature: {self.setpoint_temperature:.1f}°F"
                 )
             self.tstat.turnon()
-            self.heating_on = True
-            time.sleep(5)
-
-    def turn_off_heating(self):
-        if self.heating_on:
+            self.relay_ready_at = now + RELAY_MIN_ON_TIME
+        else:
             if DEBUG:
                 logging.info(
-                    f"Heating is turned OFF. Indoor temperature: {self.indoor_temperature:.1f}°F, Desired temperature: {self.setpoint_temperature:.1f}°F"
+                    f"{self.name}: Heating is turned OFF. Indoor temperature: {indoor_temp}, Desired temperature: {self.setpoint_temperature:.1f}°F"
                 )
             self.tstat.turnoff()
-            self.heating_on = False
-            time.sleep(5)
-
-
-    def read_temperature_from_file(self, file_path):
-        try:
-            with open(file_path, 'r') as file:
-                line = file.readline()
-                parts = line.split('\t')
-                temperature = float(parts[1])
-                timestamp_str = parts[0].strip()
-                timestamp = datetime.strptime(
-                    timestamp_str, "%a, %d %b %Y %H:%M:%S %z"
-                )
-                current_time = datetime.now()
-                age = (
-                    current_time - timestamp.replace(tzinfo=None)
-                ).total_seconds()
-                age_hours = age / 3600
-                if DEBUG:
-                    logging.debug(
-                        f"Age of temperature data: {age} seconds ({age_hours:.2f} hours)"
-                    )
-                if age > DATA_EXPIRATION_TIME:
-                    self.turn_off_heating()
-                    raise ValueError(
-                        f"Temperature data is too old: {timestamp_str}"
-                    )
-                if MIN_TEMP <= temperature <= MAX_TEMP:
-                    return temperature
-                else:
-                    self.turn_off_heating()
-                    raise ValueError(
-                        f"Temperature out of valid range: {temperature}°F"
-                    )
-        except Exception as e:
-            if DEBUG:
-                logging.error(f"Error reading temperature from {file_path}: {e}")
-            try:
-                self.turn_off_heating()
-            except:
-                pass
-            return None
+            self.relay_ready_at = now + RELAY_MIN_OFF_TIME
+        self.heating_on = self.heating_wanted
+        self.last_transition = self.clock.time()
+        self.record(heaterjournal.TRANSITION, self.branch)
 
-    def get_outdoor_temperature(self):
-        self.outdoor_temperature = self.read_temperature_from_file(outdoor_temp_file_path)
 
     def get_indoor_temperature(self):
-        self.indoor_temperature = self.read_temperature_from_file(indoor_temp_file_path)
+        self.indoor_temperature = read_temperature_from_file(self.indoor_temp_file_path, self.clock)
+
+
+# Return temperature if a reading taken at timestamp (local wall time) is
+# usable at current_time, else raise ValueError: older than
+# DATA_EXPIRATION_TIME, or outside MIN_TEMP..MAX_TEMP.
+def check_temperature(temperature, timestamp, current_time):
+    age = (
+        current_time - timestamp.replace(tzinfo=None)
+    ).total_seconds()
+    age_hours = age / 3600
+    if DEBUG:
+        logging.debug(
+            f"Age of temperature data: {age} seconds ({age_hours:.2f} hours)"
+        )
+    if age > DATA_EXPIRATION_TIME:
+        raise ValueError(
+            f"Temperature data is too old: {timestamp}"
+        )
+    if MIN_TEMP <= temperature <= MAX_TEMP:
+        return temperature
+    else:
+        raise ValueError(
+            f"Temperature out of valid range: {temperature}°F"
+        )
+
+
+# Temperature in °F from a state file, or None if it can't be read or fails
+# check_temperature(). Zones with no reading turn their heat off on the next
+# control pass.
+def read_temperature_from_file(file_path, clock=system_clock):
+    try:
+        with open(file_path, 'r') as file:
+            line = file.readline()
+            parts = line.split('\t')
+            temperature = float(parts[1])
+            timestamp_str = parts[0].strip()
+            timestamp = datetime.strptime(
+                timestamp_str, "%a, %d %b %Y %H:%M:%S %z"
+            )
+            return check_temperature(temperature, timestamp, clock.now())
+    except Exception as e:
+        if DEBUG:
+            logging.error(f"Error reading temperature from {file_path}: {e}")
+        return None
 
 
 def read_home_away():
@@ -225,6 +502,7 @@ def rfc822_timestring_now():
 
 
 def write_state(thermostat, daemon=0):
+    heater_state_file_path = thermostat.state_file_path
     tmpfile = f'{heater_state_file_path}.tmp'
     try:
         os.remove(tmpfile)
@@ -234,24 +512,61 @@ def write_state(thermostat, daemon=0):
     try:
         if daemon == 0:
             with open(tmpfile, 'w') as output_file:
-                output_file.write(f'{rfc822_timestring_now()}\tDaemon is: Running, {thermostat.report_state()}\n')
+                output_file.write(f'{rfc822_timestring_now()}\tDaemon is: Running, {thermostat.report_state()}, {ticker.report()}\n')
             os.rename(tmpfile, heater_state_file_path)
         else:
             with open(tmpfile, 'w') as output_file:
-                output_file.write(f'{rfc822_timestring_now()}\tDaemon is: Stopped, {thermostat.report_state()}\n')
+                output_file.write(f'{rfc822_timestring_now()}\tDaemon is: Stopped, {thermostat.report_state()}, {ticker.report()}\n')
             os.rename(tmpfile, heater_state_file_path)
     except Exception as e:
         logging.error(f"Error writing state to {heater_state_file_path}: {e}")
         return None
 
 
+# Save every zone's checkpoint() to checkpoint_file_path
+def save_checkpoint(thermostats):
+    tmpfile = f'{checkpoint_file_path}.tmp'
+    try:
+        with open(tmpfile, 'w') as output_file:
+            json.dump({
+                "saved_at": time.time(),
+                "zones": {t.name: t.checkpoint() for t in thermostats},
+            }, output_file)
+        os.rename(tmpfile, checkpoint_file_path)
+    except Exception as e:
+        logging.error(f"Error writing checkpoint to {checkpoint_file_path}: {e}")
+
+
+# Zone name -> checkpoint entry, or {} if there is no checkpoint younger
+# than CHECKPOINT_MAX_AGE
+def load_checkpoint():
+    try:
+        with open(checkpoint_file_path, 'r') as file:
+            checkpoint = json.load(file)
+        age = time.time() - checkpoint["saved_at"]
+        if not (0 <= age <= CHECKPOINT_MAX_AGE):
+            logging.info(f"Checkpoint is {age:.0f} seconds old, not restoring")
+            return {}
+        return checkpoint["zones"]
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logging.error(f"Error reading checkpoint from {checkpoint_file_path}: {e}")
+        return {}
+
+
 ## RPI GPIO Routines
 
-def gpio_setup():
+def gpio_setup(pins):
     GPIO.setwarnings(False)
     GPIO.setmode(GPIO.BCM)
-    GPIO.setup(BBPIN, GPIO.OUT)
-    GPIO.output(BBPIN, GPIO.HIGH)
+    for pin in pins:
+        # A pin still driven by a previous run keeps its level until the
+        # zone has checked it against the checkpoint (Thermostat.restore)
+        if GPIO.gpio_function(pin) == GPIO.OUT:
+            GPIO.setup(pin, GPIO.OUT)
+        else:
+            GPIO.setup(pin, GPIO.OUT, initial=GPIO.HIGH)
     if DEBUG:
         logging.info("GPIO Initialized")
 
@@ -270,57 +585,258 @@ class Heater:
     def turnon(self):
         GPIO.output(self.pin, GPIO.LOW)
         if DEBUG:
-            logging.info("GPIO Front Heat On (Low)")
+            logging.info(f"GPIO {self.pin} Heat On (Low)")
         self.status = True
 
     def turnoff(self):
         GPIO.output(self.pin, GPIO.HIGH)
         if DEBUG:
-            logging.info("GPIO Front Heat Off (High)")
+            logging.info(f"GPIO {self.pin} Heat Off (High)")
         self.status = False
 
+    def is_on(self):
+        return GPIO.input(self.pin) == GPIO.LOW
+
 def quit_handler(signum, frame):
     logging.info(f"Signal {signum} received. Cleaning-up and exiting")
-    thermostat.turn_off_heating()
-    write_state(thermostat,-1)
+    for thermostat in thermostats:
+        thermostat.turn_off_heating(heaterjournal.SHUTDOWN, force=True)
+        write_state(thermostat,-1)
+    save_checkpoint(thermostats)
+    journal.close()
     gpio_cleanup()
-    time.sleep(3)
     exit(0)
 
-# Initialize
-gpio_setup()
-frontbb = Heater(BBPIN)
 
-## Signal handlers
-signal.signal(signal.SIGINT, quit_handler)
-signal.signal(signal.SIGQUIT, quit_handler)
-signal.signal(signal.SIGTERM, quit_handler)
+# Exit for a restart: checkpoint, but leave the relays and GPIO as they are
+# so the next run can pick them up
+def handoff_handler(signum, frame):
+    logging.info(f"Signal {signum} received. Checkpointing and exiting for restart")
+    save_checkpoint(thermostats)
+    journal.close()
+    exit(RESTART_EXIT_STATUS)
+
+
+# Zone table from THERMOSTAT_ZONES_FILE, or the main zone at the setpoint
+# given on the command line
+def load_zones(argv):
+    zones_file = os.getenv("THERMOSTAT_ZONES_FILE")
+    if zones_file:
+        with open(zones_file, 'r') as file:
+            zones = json.load(file)
+    else:
+        if len(argv) < 2:
+            raise ValueError("No setpoint temperature given")
+        zones = [{
+            "name": "main",
+            "pin": BBPIN,
+            "sensor_file": os.getenv("MAIN_OUTPUT_FILE"),
+            "state_file": os.getenv("HEATER_STATE_FILE"),
+            "setpoint": float(argv[1]),
+        }]
+
+    if not isinstance(zones, list) or not zones:
+        raise ValueError("Zones file must be a non-empty JSON list of zones")
+
+    names = set()
+    pins = set()
+    for zone in zones:
+        if not isinstance(zone, dict) or not isinstance(zone.get("name"), str):
+            raise ValueError(f"Every zone must be an object with a name: {zone!r}")
+        zone.setdefault("start_hour", DEFAULT_START_HOUR)
+        zone.setdefault("end_hour", DEFAULT_END_HOUR)
+        zone.setdefault("hysteresis", DEFAULT_HYSTERESIS)
+        zone.setdefault("outdoor_disable_point", OUTDOOR_TEMP_DISABLE_POINT)
+        zone.setdefault("state_file", f'{os.getenv("HEATER_STATE_FILE")}-{zone["name"]}')
+        check_zone(zone)
+        if not (60 <= zone["setpoint"] <= 75):
+            raise ValueError(f"{zone['name']}: Setpoint temperature must be between 60 and 75°F.")
+        if zone["name"] in names or zone["pin"] in pins:
+            raise ValueError(f"{zone['name']}: name and pin must be unique")
+        names.add(zone["name"])
+        pins.add(zone["pin"])
+    return zones
+
+
+# Raise ValueError unless every ZONE_TYPES setting is there, of the right
+# type and in range
+def check_zone(zone):
+    name = zone["name"]
+    for key, types in ZONE_TYPES.items():
+        if zone.get(key) is None:
+            raise ValueError(f"{name}: {key} is missing")
+        value = zone[key]
+        if isinstance(value, bool) or not isinstance(value, types):
+            raise ValueError(f"{name}: {key} must be {' or '.join(t.__name__ for t in types)}, not {value!r}")
+        if isinstance(value, float) and not math.isfinite(value):
+            raise ValueError(f"{name}: {key} must be finite")
+    if zone["pin"] < 0:
+        raise ValueError(f"{name}: pin must not be negative")
+    for key in ("start_hour", "end_hour"):
+        if not (0 <= zone[key] <= 24):
+            raise ValueError(f"{name}: {key} must be between 0 and 24")
+    if zone["hysteresis"] < 0:
+        raise ValueError(f"{name}: hysteresis must not be negative")
+
+
+def reload_handler(signum, frame):
+    global reload_requested
+    reload_requested = True
+    watcher.wake()
+
+
+# Re-read THERMOSTAT_ZONES_FILE and apply it to the running zones. A file
+# that doesn't load is logged and the current settings are kept. Returns
+# the thermostats whose settings changed.
+def reload_zones():
+    if not os.getenv("THERMOSTAT_ZONES_FILE"):
+        logging.warning("Reload requested, but there is no THERMOSTAT_ZONES_FILE to reload")
+        return []
 
-# Parse setpoint_temperature from command line arguments
-try:
-    setpoint_temperature = float(sys.argv[1])
-    if not (60 <= setpoint_temperature <= 75):
-        raise ValueError("Setpoint temperature must be between 60 and 75°F.")
-except (IndexError, ValueError) as e:
-    if DEBUG:
-        logging.error(f"Error: {e}")
-        logging.info(
-            "Usage: python3 thermostat_controller.py <setpoint_temperature>"
-        )
-    gpio_cleanup()
-    time.sleep(3)
-    sys.exit(1)
-
-# Setup the thermostat
-start_hour = 9
-end_hour = 23
-hysteresis = 1.0
-thermostat = Thermostat(
-    frontbb, setpoint_temperature, start_hour, end_hour, hysteresis
-)
-
-# Outer loop to control temperature
-while True:
-    thermostat.update_temperature()
-    write_state(thermostat)
-    time.sleep(LOOP_SLEEP_TIME)
+    try:
+        new_zones = {zone["name"]: zone for zone in load_zones(sys.argv)}
+    except (OSError, KeyError, TypeError, ValueError) as e:
+        logging.error(f"Error reloading zones, keeping current settings: {e}")
+        return []
+
+    reconfigured = []
+    for zone, thermostat in zip(zones, thermostats):
+        new_zone = new_zones.pop(zone["name"], None)
+        if new_zone is None:
+            logging.warning(f"{zone['name']}: removed from zones file, restart to apply")
+            continue
+        for key in zone:
+            if key not in RELOADABLE and new_zone.get(key) != zone[key]:
+                logging.warning(f"{zone['name']}: {key} changed, restart to apply")
+        if any(new_zone[key] != zone[key] for key in RELOADABLE):
+            thermostat.reconfigure(new_zone)
+            zone.update({key: new_zone[key] for key in RELOADABLE})
+            reconfigured.append(thermostat)
+    for name in new_zones:
+        logging.warning(f"{name}: added to zones file, restart to apply")
+
+    logging.info(f"Zones reloaded, {len(reconfigured)} changed")
+    return reconfigured
+
+
+def main():
+    global zones, thermostats, reload_requested, watcher, ticker, journal
+
+    # Configure logging
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        filename=logfile,
+        filemode='a'
+    )
+
+    # Parse the zones before touching any GPIO
+    try:
+        zones = load_zones(sys.argv)
+    except (OSError, KeyError, TypeError, ValueError) as e:
+        if DEBUG:
+            logging.error(f"Error: {e}")
+            logging.info(
+                "Usage: python3 thermostat2.py <setpoint_temperature>, or set THERMOSTAT_ZONES_FILE"
+            )
+        sys.exit(1)
+
+    if GPIO is None:
+        logging.error("RPi.GPIO is not available, can't drive the heaters")
+        sys.exit(1)
+
+    # Initialize
+    gpio_setup([zone["pin"] for zone in zones])
+    thermostats = []
+    reload_requested = False
+    watcher = fswatch.Watcher()
+    ticker = FixedRateTicker(LOOP_SLEEP_TIME)
+    journal = heaterjournal.Journal()
+
+    ## Signal handlers
+    signal.signal(signal.SIGINT, quit_handler)
+    signal.signal(signal.SIGQUIT, quit_handler)
+    signal.signal(signal.SIGTERM, quit_handler)
+    signal.signal(signal.SIGHUP, reload_handler)
+    signal.signal(signal.SIGUSR2, handoff_handler)
+
+    # Setup the thermostats
+    inputs = SharedInputs()
+    checkpoints = load_checkpoint()
+    for zone in zones:
+        thermostats.append(Thermostat(
+            zone["name"],
+            Heater(zone["pin"]),
+            inputs,
+            f'{output_file_path}/{zone["sensor_file"]}',
+            f'{output_file_path}/{zone["state_file"]}',
+            zone["setpoint"], zone["start_hour"], zone["end_hour"], zone["hysteresis"],
+            zone["outdoor_disable_point"], checkpoints.get(zone["name"]),
+            journal=journal
+        ))
+
+    # Wake as soon as a reading, the home/away switch or the zones file changes.
+    # The writers replace these files with an atomic rename, editors either
+    # rename or rewrite in place.
+    for path in [outdoor_temp_file_path, hk_home_away_file_path] + [t.indoor_temp_file_path for t in thermostats]:
+        watcher.add(path, fswatch.IN_REPLACED)
+    zones_file_path = os.getenv("THERMOSTAT_ZONES_FILE")
+    if zones_file_path:
+        watcher.add(zones_file_path, fswatch.IN_REPLACED)
+
+    # Outer loop to control temperature, one pass for all zones. Only the files
+    # that changed are re-read, and only the zones they affect run, everything
+    # is re-read on the fixed-rate safety tick so stale data still expires. A
+    # relay change held back by the minimum on/off time is made at its deadline.
+    while True:
+        wake = min([ticker.next_tick] + [t.relay_due for t in thermostats if t.relay_due is not None])
+        changed = watcher.read(max(0.0, wake - time.monotonic()))
+
+        now = time.monotonic()
+        if reload_requested or (zones_file_path and zones_file_path in changed):
+            reload_requested = False
+            changed.discard(zones_file_path)
+            ran = reload_zones()
+            for thermostat in ran:
+                thermostat.control_temperature()
+            for thermostat in ran:
+                write_state(thermostat)
+            save_checkpoint(thermostats)
+            if not changed:
+                continue
+
+        if ticker.due(now):
+            ticker.tick(now)
+            # Quiet stretches append too few records to fill a batch, this
+            # is what holds the journal to SYNC_INTERVAL
+            try:
+                journal.sync()
+            except OSError as e:
+                logging.error(f"Error syncing heater journal: {e}")
+            inputs.update()
+            ran = thermostats
+            for thermostat in ran:
+                thermostat.update_temperature()
+        elif changed:
+            if DEBUG:
+                logging.debug(f"Changed: {', '.join(sorted(changed))}")
+            shared = inputs.update(changed)
+            ran = [t for t in thermostats if shared or t.indoor_temp_file_path in changed]
+            for thermostat in ran:
+                thermostat.update_temperature(changed)
+        else:
+            ran = [t for t in thermostats if t.relay_due is not None and now >= t.relay_due]
+            for thermostat in ran:
+                thermostat.apply_relay()
+
+        if ran:
+            ticker.record_pass(time.monotonic() - now)
+        for thermostat in ran:
+            write_state(thermostat)
+        if ran:
+            save_checkpoint(thermostats)
+
+
+## MAIN ##
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/bin/python3
+
+# What-if evaluation of thermostat2.py settings against recorded weather.
+#
+# Loads the outdoor (Midway) and indoor (Main thermostat) history from the
+# measurements table and replays the thermostat2 decision rules for every
+# combination of settings in GRID at once. Each setting is a NumPy array
+# with one entry per combination, so the only Python loop walks time (one
+# step per STEP seconds), never the grid.
+#
+# The room is the first-order model thermosim.py uses, started from the
+# recorded indoor temperature, with the heat loss rate fitted to the
+# recorded overnight cooling where there is enough of it. Home/away isn't
+# recorded, so the house is taken as occupied throughout.
+#
+# Reports, per combination, predicted heater hours, relay cycles and hours
+# below COMFORT_MIN_TEMP during COMFORT_HOURS, best first.
+#
+# Usage: thermowhatif.py <start> <end> [top_n]
+#        start/end are ISO dates or datetimes, local time if no offset given
+
+import sys
+import time
+from datetime import datetime
+import numpy as np
+import psycopg2
+from dotenv import load_dotenv
+
+import envdb
+from envquery import parse_time
+import thermosim
+from thermostat2 import DATA_EXPIRATION_TIME
+
+# Stations in the measurements table
+INDOOR_STATION = 0    # Main Omnistat, see TSTATS in updateenvironmental.py
+OUTDOOR_STATION = 100  # Midway METAR
+
+# Replay step, seconds
+STEP = 600
+
+# Settings to try, every combination is evaluated
+GRID = {
+    "setpoint": np.arange(66.0, 72.01, 0.5),
+    "hysteresis": np.array([0.5, 1.0, 1.5]),
+    "start_hour": np.array([7, 8, 9]),
+    "end_hour": np.array([22, 23]),
+    "outdoor_disable_point": np.array([40, 45, 50]),
+}
+
+# What the settings are judged against: too cold is below COMFORT_MIN_TEMP
+# between COMFORT_HOURS, whatever the setpoint
+COMFORT_MIN_TEMP = 67.0
+COMFORT_HOURS = (8, 22)
+
+# Bounds for a fitted heat loss rate (per hour) to be believed
+LOSS_RATE_BOUNDS = (0.01, 0.5)
+
+
+# (epoch seconds, temperature_f) arrays for one station, in time order
+def load_series(station, start, end):
+    def work(conn):
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT recorded_at, temperature_f FROM measurements "
+                "WHERE station_id = %s AND recorded_at >= %s AND recorded_at < %s "
+                "AND temperature_f IS NOT NULL ORDER BY recorded_at",
+                (station, start, end)
+            )
+            return cursor.fetchall()
+
+    rows = envdb.run_with_retries(work)
+    times = np.fromiter((r[0].timestamp() for r in rows), dtype=np.float64, count=len(rows))
+    temps = np.fromiter((r[1] for r in rows), dtype=np.float64, count=len(rows))
+    return times, temps
+
+
+# Every combination of the GRID values, as one flat array per setting
+def grid_settings(grid):
+    mesh = np.meshgrid(*grid.values(), indexing='ij')
+    return {name: values.ravel() for name, values in zip(grid, mesh)}
+
+
+# Heat loss rate (per hour) from recorded cooling: for consecutive indoor
+# readings an hour or so apart where the room cooled while well above the
+# outdoor temperature, -dT/dt / (T - Tout). The median is robust to the
+# hours some other heat source was on.
+def fit_loss_rate(indoor_times, indoor, outdoor_times, outdoor):
+    if len(indoor) < 2 or len(outdoor) == 0:
+        return None
+    dt = np.diff(indoor_times) / 3600
+    dT = np.diff(indoor)
+    diff = indoor[:-1] - np.interp(indoor_times[:-1], outdoor_times, outdoor)
+    use = (dt > 0.5) & (dt < 1.5) & (dT < 0) & (diff > 10)
+    if use.sum() < 24:
+        return None
+    rate = float(np.median(-dT[use] / dt[use] / diff[use]))
+    if not (LOSS_RATE_BOUNDS[0] <= rate <= LOSS_RATE_BOUNDS[1]):
+        return None
+    return rate
+
+
+# Replay the decision rules of Thermostat.control_temperature for every
+# combination in settings over the outdoor history. Returns a dict of
+# per-combination result arrays.
+def evaluate(settings, outdoor_times, outdoor, initial_indoor, start, end,
+             loss_rate=thermosim.LOSS_RATE, heat_rate=thermosim.HEAT_RATE):
+    steps = np.arange(start, end, STEP, dtype=np.float64)
+    hours = np.array([datetime.fromtimestamp(t).hour for t in steps])
+    step_hours = STEP / 3600
+
+    # What the controller sees is the last reading (forward filled, expiring
+    # like a state file), the room follows the interpolated temperature
+    last = np.searchsorted(outdoor_times, steps, side='right') - 1
+    seen = outdoor[np.maximum(last, 0)]
+    stale = (last < 0) | (steps - outdoor_times[np.maximum(last, 0)] > DATA_EXPIRATION_TIME)
+    actual = np.interp(steps, outdoor_times, outdoor)
+    comfort_hours = (hours >= COMFORT_HOURS[0]) & (hours < COMFORT_HOURS[1])
+
+    setpoint = settings["setpoint"]
+    low = setpoint - settings["hysteresis"]
+    high = setpoint + settings["hysteresis"]
+    start_hour = settings["start_hour"]
+    end_hour = settings["end_hour"]
+    disable_point = settings["outdoor_disable_point"]
+
+    n = len(setpoint)
+    room = np.full(n, float(initial_indoor))
+    on = np.zeros(n, dtype=bool)
+    on_steps = np.zeros(n, dtype=np.int64)
+    cycles = np.zeros(n, dtype=np.int64)
+    cold_steps = np.zeros(n, dtype=np.int64)
+
+    for i in range(len(steps)):
+        if stale[i]:
+            can_heat = np.zeros(n, dtype=bool)
+        else:
+            can_heat = (start_hour <= hours[i]) & (hours[i] < end_hour) & (seen[i] < disable_point)
+        # Below the band turns on, above turns off, in between holds
+        new_on = can_heat & ((room < low) | (on & (room <= high)))
+        cycles += new_on & ~on
+        on = new_on
+        on_steps += on
+        if comfort_hours[i]:
+            cold_steps += room < COMFORT_MIN_TEMP
+        room += step_hours * (heat_rate * on - loss_rate * (room - actual[i]))
+
+    return {
+        "heater_hours": on_steps * step_hours,
+        "cycles": cycles,
+        "cold_hours": cold_steps * step_hours,
+        "final_room_temperature": room,
+    }
+
+
+def print_results(settings, results, top_n):
+    # Fewest cold hours first, then least heating
+    order = np.lexsort((results["heater_hours"], results["cold_hours"]))
+    columns = list(settings) + ["heater_hours", "cycles", "cold_hours"]
+    print("\t".join(columns))
+    for i in order[:top_n]:
+        values = [settings[c][i] for c in settings] + [results[c][i] for c in ("heater_hours", "cycles", "cold_hours")]
+        print("\t".join(f"{v:g}" for v in values))
+
+
+## MAIN ##
+if __name__ == "__main__":
+    load_dotenv()
+
+    if len(sys.argv) not in (3, 4):
+        print("Usage: python thermowhatif.py <start> <end> [top_n]")
+        sys.exit(1)
+
+    try:
+        start = parse_time(sys.argv[1])
+        end = parse_time(sys.argv[2])
+        top_n = int(sys.argv[3]) if len(sys.argv) == 4 else 20
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    try:
+        outdoor_times, outdoor = load_series(OUTDOOR_STATION, start, end)
+        indoor_times, indoor = load_series(INDOOR_STATION, start, end)
+    except psycopg2.DatabaseError as e:
+        print(f"Database error: {e}")
+        sys.exit(1)
+    finally:
+        envdb.close()
+
+    if len(outdoor) == 0 or len(indoor) == 0:
+        print("No indoor or outdoor readings in that range")
+        sys.exit(1)
+
+    loss_rate = fit_loss_rate(indoor_times, indoor, outdoor_times, outdoor)
+    if loss_rate is None:
+        loss_rate = thermosim.LOSS_RATE
+        print(f"Not enough overnight cooling to fit the room, using loss rate {loss_rate}/h")
+    else:
+        print(f"Fitted loss rate {loss_rate:.3f}/h")
+
+    settings = grid_settings(GRID)
+    started = time.monotonic()
+    results = evaluate(settings, outdoor_times, outdoor, indoor[0],
+                       start.timestamp(), end.timestamp(), loss_rate)
+    elapsed = time.monotonic() - started
+
+    print_results(settings, results, top_n)
+    print(f"{len(settings['setpoint'])} combinations over {(end - start).days} days in {elapsed:.2f}s")
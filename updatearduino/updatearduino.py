@@ -9,9 +9,9 @@ from iot_api_client.models import *
 
 import time
 import os
+import sys
 import shutil
 import stat
-import psycopg2
 from datetime import datetime
 from time import sleep
 from dotenv import load_dotenv
@@ -20,6 +20,11 @@ from dotenv import load_dotenv
 load_dotenv()  # take environment variables from .env.
 load_dotenv('../.env')  # take environment variables from .env.
 
+# Shared modules live one level up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import envdb
+import outbox
+
 HOST = "https://api2.arduino.cc"
 TOKEN_URL = "https://api2.arduino.cc/iot/v1/clients/token"
 
@@ -120,6 +125,7 @@ def get_things_and_props():
     things_api = ThingsV2Api(client)
     properties_api = PropertiesV2Api(client)
     
+    rows = []
     try:
         things = things_api.things_v2_list()
         for thing in things:
@@ -130,111 +136,64 @@ def get_things_and_props():
             if tname.casefold() == "outdoor-pod-main":
                 properties=properties_api.properties_v2_list(id=thing.id, show_deleted=False)  
                 write_to_file(outdoor_wx_output_file_path, properties)
-                insert_into_database(10, properties)
+                rows.append(measurement_row(10, properties))
 
             if tname.casefold() == "george-pod-1":
                 properties=properties_api.properties_v2_list(id=thing.id, show_deleted=False)  
                 write_to_file(george_wx_output_file_path, properties)
-                insert_into_database(11, properties)
+                rows.append(measurement_row(11, properties))
 
             if tname.casefold() == "mbr-pod-1":
                 properties=properties_api.properties_v2_list(id=thing.id, show_deleted=False)  
                 write_to_file(mbr_wx_output_file_path, properties)
-                insert_into_database(12, properties)
+                rows.append(measurement_row(12, properties))
 
     except Exception as e:
         print("Exception: {}".format(e))
 
-
-def insert_into_database(station, properties):
-    try:
-        connection = psycopg2.connect(
-            dbname=os.getenv("DB_NAME"),
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASS"),
-            host=os.getenv("DB_HOST"),
-            port=os.getenv("DB_PORT")
-        )
-        cursor = connection.cursor()
-
-        for prop in properties:
-            # Truncate all timestamps to seconds
-            prop.value_updated_at = prop.value_updated_at.replace(microsecond=0)
-
-            match prop.variable_name:
-                case "temperature":
-                    temperature_value = prop.last_value
-                    temperature_updated_at = prop.value_updated_at
-                case "humidity":
-                    humidity_value = prop.last_value
-                    humidity_updated_at = prop.value_updated_at
-                case "altimeterSetting":
-                    altimeterSetting_value = prop.last_value
-                    altimeterSetting_updated_at = prop.value_updated_at
-                case "dewpoint":
-                    dewpoint_value = prop.last_value
-                    dewpoint_updated_at = prop.value_updated_at
-                case "gas":
-                    gas_value = prop.last_value
-                    gas_updated_at = prop.value_updated_at
-                case "seaLevelPressure":
-                    seaLevelPressure_value = prop.last_value
-                    seaLevelPressure_updated_at = prop.value_updated_at
-                case "stationPressure":
-                    stationPressure_value = prop.last_value
-                    stationPressure_updated_at = prop.value_updated_at
-                case "updays":
-                    updays_value = prop.last_value
-                    updays_updated_at = prop.value_updated_at
-                case "airQuality":
-                    airQuality_value = prop.last_value
-                    airQuality_updated_at = prop.value_updated_at
-                case "airQualityQual":
-                    airQualityQual_value = prop.last_value
-                    airQualityQual_updated_at = prop.value_updated_at
-                case "deviations":
-                    deviations_value = prop.last_value
-                    deviations_updated_at = prop.value_updated_at
-                case "errors":
-                    errors_value = prop.last_value
-                    errors_updated_at = prop.value_updated_at
-                case _:
-                    print("ERROR {} not found".format(prop.variable_name))
-
+    # All pods in one transaction
+    rows = [row for row in rows if "recorded_at" in row]
+    outbox.write("measurements", rows)
+    outbox.flush()
+    envdb.close()
+
+
+# Arduino IoT Cloud property -> measurements column
+PROPERTY_COLUMNS = {
+    "temperature": "temperature_f",
+    "humidity": "humidity_percent",
+    "altimeterSetting": "pressure_inhg",
+    "dewpoint": "dewpoint",
+    "gas": "gas",
+    "seaLevelPressure": "sealevelpressure",
+    "stationPressure": "stationpressure",
+    "updays": "updays",
+    "airQuality": "airquality",
+    "airQualityQual": "airqualityqual",
+    "deviations": "deviations",
+    "errors": "errors",
+}
+
+
+# Build the measurements row for one pod
+def measurement_row(station, properties):
+    row = {"station_id": station}
+
+    for prop in properties:
+        # Truncate all timestamps to seconds
+        prop.value_updated_at = prop.value_updated_at.replace(microsecond=0)
+
+        column = PROPERTY_COLUMNS.get(prop.variable_name)
+        if column is None:
+            print("ERROR {} not found".format(prop.variable_name))
+            continue
+        row[column] = prop.last_value
 
         ## NOTE: We use the temperature_updated_at timestamp for everything DB related
-        
-        # Check if an entry exists for the current wallclock hour
-        check_query = """
-            SELECT COUNT(*) FROM measurements
-            WHERE station_id = %s AND DATE_TRUNC('hour', recorded_at) = DATE_TRUNC('hour', %s::TIMESTAMP WITH TIME ZONE)
-        """
-        cursor.execute(check_query, (station, temperature_updated_at))
-        #print(cursor.query)
-        result = cursor.fetchone()
-
-        if result[0] == 0:
-            insert_query = """
-                INSERT INTO measurements (recorded_at, station_id, temperature_f, humidity_percent, pressure_inhg,
-                                          dewpoint, gas, seaLevelPressure, stationPressure, updays, 
-                                          airQuality, airQualityQual, deviations, errors)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """
-            cursor.execute(insert_query, (
-                temperature_updated_at, station, temperature_value, humidity_value, altimeterSetting_value,
-                dewpoint_value, gas_value, seaLevelPressure_value, stationPressure_value, updays_value, 
-                airQuality_value, airQualityQual_value, deviations_value, errors_value
-            ))
-
-            connection.commit()
-            #print(cursor.query)
-   
-        cursor.close()
-        connection.close()
-    except psycopg2.DatabaseError as e:
-        print(f"Database error: {e}")
-    except Exception as e:
-        print(f"Unexpected error: {e}")
+        if prop.variable_name == "temperature":
+            row["recorded_at"] = prop.value_updated_at
+
+    return row
 
 
 #################
@@ -2,13 +2,17 @@
 
 import re
 import os
+import sys
+import signal
 import shutil
 import stat
 from datetime import datetime, timedelta
 import time
-import psycopg2
 from dotenv import load_dotenv
 import xml.etree.ElementTree as ET
+import fswatch
+import envdb
+import outbox
 
 # Load environment variables from .env file
 load_dotenv()
@@ -23,6 +27,16 @@ main_output_file_path = f'{output_file_path}/{os.getenv("MAIN_OUTPUT_FILE")}'
 george_output_file_path = f'{output_file_path}/{os.getenv("GEORGE_OUTPUT_FILE")}'
 mbr_output_file_path = f'{output_file_path}/{os.getenv("MBR_OUTPUT_FILE")}'
 
+# Where we left off in the Omnistat log between runs (inode and byte offset)
+tstat_offset_file_path = f'{output_file_path}/tstat.offset'
+
+# With no saved offset, only look at this much of the end of the log
+TAIL_BOOTSTRAP_BYTES = 1024 * 1024
+
+# In daemon mode, re-check both inputs at least this often (seconds) in case
+# an inotify event was missed
+DAEMON_RESCAN_TIME = 5 * 60
+
 
 def ensure_directory_exists(path):
     try:
@@ -79,159 +93,261 @@ def extract_temperature_from_xml():
     return None
 
 
-# Gets temp from Omnistat log in Misterhouse
-# Writes to local file
-def extract_indoor_temperature_from_log(stat):
+def load_log_offset():
+    try:
+        with open(tstat_offset_file_path, 'r') as offset_file:
+            parts = offset_file.readline().split('\t')
+            return int(parts[0]), int(parts[1])
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Error reading log offset {tstat_offset_file_path}: {e}")
 
-    # Common temp file for all
-    tmpfile = f'{output_file_path}/tstat.tmp'
+    return None, None
 
+
+def save_log_offset(inode, offset):
+    tmpfile = f'{tstat_offset_file_path}.tmp'
     try:
-        os.remove(tmpfile)
-    except:
-        pass
+        with open(tmpfile, 'w') as offset_file:
+            offset_file.write(f"{inode}\t{offset}\n")
+        os.rename(tmpfile, tstat_offset_file_path)
+    except Exception as e:
+        print(f"Error writing log offset {tstat_offset_file_path}: {e}")
+
+
+# Returns only the lines appended to the Omnistat log since the last run.
+# The saved inode/offset lets us notice when MisterHouse rotates or truncates
+# the log, in which case we start again from the top of the new file.
+def read_new_log_lines():
+    inode, offset = load_log_offset()
 
     try:
-        if stat == "MAIN":
-            pattern = r"(\d{2}/\d{2}/\d{2} \d{2}:\d{2}:\d{2} [APM]{2})  Main Omnistat RC-2000: Indoor temp is (\d+), humidity is (\d+), HVAC Command: .*"
-            outfile = main_output_file_path
-            with open(tstat_input_file_path, 'r') as log_file:
-                lines = log_file.readlines()
-
-        elif stat == "GEORGE":
-            #                                     02/12/25 12:20:41 AM  George Omnistat RC-80: Indoor temp is 66, HVAC Command: off, heat to 70, cool to 82, mode: off
-            pattern = r"(\d{2}/\d{2}/\d{2} \d{2}:\d{2}:\d{2} [APM]{2})  George Omnistat RC-80: Indoor temp is (\d+), HVAC Command: .*"
-            outfile = george_output_file_path
-            with open(tstat_input_file_path, 'r') as log_file:
-                lines = log_file.readlines()
-            
-        elif stat == "MBR":
-            #                                     02/12/25 12:20:21 AM  MBR Omnistat RC-80: Indoor temp is 65, HVAC Command: off, heat to 62, cool to 82, mode: off
-            pattern = r"(\d{2}/\d{2}/\d{2} \d{2}:\d{2}:\d{2} [APM]{2})  MBR Omnistat RC-80: Indoor temp is (\d+), HVAC Command: .*"
-            outfile = mbr_output_file_path
-            with open(tstat_input_file_path, 'r') as log_file:
-                lines = log_file.readlines()
-        
-        else: 
-            print("Error: Invalid thermostat specified.")
-            return None
-
-        # Iterate from the end of the file to find the first matching line
-        for line in reversed(lines):
-            match = re.search(pattern, line)
-            if match:
-                timestamp_str = match.group(1)
-                indoor_temp = float(match.group(2))
-
-                if stat == "MAIN":
-                    indoor_humid = float(match.group(3))
-                else:
-                    indoor_humid = None
-
-                # Convert the timestamp to RFC 822 format with local UTC offset
-                try:
-                    timestamp = datetime.strptime(timestamp_str, "%m/%d/%y %I:%M:%S %p")
-                    local_utc_offset = -time.timezone if time.localtime().tm_isdst == 0 else -time.altzone
-                    utc_offset_hours = local_utc_offset // 3600
-                    utc_offset_minutes = (local_utc_offset % 3600) // 60
-                    utc_offset_str = f"{utc_offset_hours:+03d}{utc_offset_minutes:02d}"
-                    rfc822_timestamp = timestamp.strftime("%a, %d %b %Y %H:%M:%S ") + utc_offset_str
-                    pg_timestamp = timestamp.strftime("%d-%b-%Y %H:%M:%S") + f"{utc_offset_hours:+03d}"
-
-                    # Write to /var/environment
-                    with open(tmpfile, 'w') as output_file:
-                        output_file.write(f"{rfc822_timestamp}\t{indoor_temp}\t{stat}\n")
-                    os.rename(tmpfile, outfile)
-                    
-                    return pg_timestamp, stat, indoor_temp, indoor_humid
-                except ValueError as e:
-                    print(f"Error parsing timestamp {timestamp_str}: {e}")
-    except FileNotFoundError as e:
+        with open(tstat_input_file_path, 'rb') as log_file:
+            st = os.fstat(log_file.fileno())
+
+            if inode is None:
+                # First run, the newest readings are all we need
+                offset = max(0, st.st_size - TAIL_BOOTSTRAP_BYTES)
+            elif st.st_ino != inode or st.st_size < offset:
+                # Rotated or truncated
+                offset = 0
+
+            log_file.seek(offset)
+            data = log_file.read()
+    except OSError as e:
         print(f"Error reading log file {tstat_input_file_path}: {e}")
-    except Exception as e:
-        print(f"Unexpected error: {e}")
+        return []
+
+    # Only consume whole lines, a partially written one is picked up next run
+    end = data.rfind(b'\n') + 1
+    save_log_offset(st.st_ino, offset + end)
+
+    lines = data[:end].decode('utf-8', errors='replace').splitlines()
+    if inode is None and offset > 0 and lines:
+        # Started mid-line
+        lines = lines[1:]
+    return lines
+
+
+# Convert an Omnistat log timestamp to RFC 822 (state files) and
+# Postgres (DB) formats, both with the local UTC offset
+def omnistat_timestamps(timestamp_str):
+    timestamp = datetime.strptime(timestamp_str, "%m/%d/%y %I:%M:%S %p")
+    local_utc_offset = -time.timezone if time.localtime().tm_isdst == 0 else -time.altzone
+    utc_offset_hours = local_utc_offset // 3600
+    utc_offset_minutes = (local_utc_offset % 3600) // 60
+    utc_offset_str = f"{utc_offset_hours:+03d}{utc_offset_minutes:02d}"
+    rfc822_timestamp = timestamp.strftime("%a, %d %b %Y %H:%M:%S ") + utc_offset_str
+    pg_timestamp = timestamp.strftime("%d-%b-%Y %H:%M:%S") + f"{utc_offset_hours:+03d}"
+    return rfc822_timestamp, pg_timestamp
+
+
+# Every line we care about has this in it, anything else is skipped
+# without touching the regex engine
+OMNISTAT_PREFILTER = " Omnistat RC-"
+
+OMNISTAT_TIMESTAMP = r"(?P<timestamp>\d{2}/\d{2}/\d{2} \d{2}:\d{2}:\d{2} [APM]{2})"
+
+# Omnistat thermostats reported in the MisterHouse log, by name.
+#   prefilter: literal that must be in the line before the pattern is tried
+#   pattern:   compiled regex, humidity group is optional
+#   outfile:   state file under OUTPUT_FILE_PATH
+#   station:   station_id in the measurements table
+TSTATS = {
+    # 02/12/25 12:20:41 AM  Main Omnistat RC-2000: Indoor temp is 66, humidity is 40, HVAC Command: off, ...
+    "MAIN": {
+        "prefilter": "  Main Omnistat RC-2000: ",
+        "pattern": re.compile(OMNISTAT_TIMESTAMP + r"  Main Omnistat RC-2000: Indoor temp is (?P<temp>\d+), humidity is (?P<humidity>\d+), HVAC Command: .*"),
+        "outfile": main_output_file_path,
+        "station": 0,
+    },
+    # 02/12/25 12:20:41 AM  George Omnistat RC-80: Indoor temp is 66, HVAC Command: off, heat to 70, cool to 82, mode: off
+    "GEORGE": {
+        "prefilter": "  George Omnistat RC-80: ",
+        "pattern": re.compile(OMNISTAT_TIMESTAMP + r"  George Omnistat RC-80: Indoor temp is (?P<temp>\d+), HVAC Command: .*"),
+        "outfile": george_output_file_path,
+        "station": 1,
+    },
+    # 02/12/25 12:20:21 AM  MBR Omnistat RC-80: Indoor temp is 65, HVAC Command: off, heat to 62, cool to 82, mode: off
+    "MBR": {
+        "prefilter": "  MBR Omnistat RC-80: ",
+        "pattern": re.compile(OMNISTAT_TIMESTAMP + r"  MBR Omnistat RC-80: Indoor temp is (?P<temp>\d+), HVAC Command: .*"),
+        "outfile": mbr_output_file_path,
+        "station": 2,
+    },
+}
+
+
+# One pass over the log, newest line first, picking out the latest
+# reading for every thermostat in TSTATS. Stops as soon as all are found.
+# Returns {name: (timestamp_str, temp, humidity)}
+def scan_thermostat_log(lines):
+    readings = {}
+
+    for line in reversed(lines):
+        if OMNISTAT_PREFILTER not in line:
+            continue
+
+        for stat, tstat in TSTATS.items():
+            if stat in readings or tstat["prefilter"] not in line:
+                continue
+
+            match = tstat["pattern"].search(line)
+            if match:
+                humidity = match.group("humidity") if "humidity" in tstat["pattern"].groupindex else None
+                readings[stat] = (
+                    match.group("timestamp"),
+                    float(match.group("temp")),
+                    float(humidity) if humidity is not None else None,
+                )
+            break
 
-    return None
+        if len(readings) == len(TSTATS):
+            break
 
+    return readings
 
-def insert_into_database(timestamp, location, temp, humidity, pressure):
+
+# Gets temps for all thermostats from Omnistat log in Misterhouse
+# Writes each to its local file
+# Returns {name: (pg_timestamp, name, temp, humidity)}
+def extract_indoor_temperatures_from_log(lines):
+
+    # Common temp file for all
+    tmpfile = f'{output_file_path}/tstat.tmp'
+
+    results = {}
     try:
-        connection = psycopg2.connect(
-            dbname=os.getenv("DB_NAME"),
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASS"),
-            host=os.getenv("DB_HOST"),
-            port=os.getenv("DB_PORT")
-        )
-        cursor = connection.cursor()
-
-        # Check if an entry exists for the current wallclock hour
-        check_query = """
-            SELECT COUNT(*) FROM measurements
-            WHERE station_id = %s AND DATE_TRUNC('hour', recorded_at) = DATE_TRUNC('hour', %s::TIMESTAMP WITH TIME ZONE)
-        """
-        cursor.execute(check_query, (location, timestamp))
-        #print(cursor.query)
-        result = cursor.fetchone()
-
-        if result[0] == 0:
-            if humidity and pressure:
-                insert_query = """
-                    INSERT INTO measurements (recorded_at, station_id, temperature_f, humidity_percent, pressure_inhg)
-                    VALUES (%s, %s, %s, %s, %s)
-                """
-                cursor.execute(insert_query, (timestamp, location, temp, humidity, pressure))
-                connection.commit()
-                #print(cursor.query)
-            elif humidity and not pressure:
-                insert_query = """
-                    INSERT INTO measurements (recorded_at, station_id, temperature_f, humidity_percent)
-                    VALUES (%s, %s, %s, %s)
-                """
-                cursor.execute(insert_query, (timestamp, location, temp, humidity))
-                connection.commit()
-                #print(cursor.query)
-            elif not humidity and not pressure:
-                insert_query = """
-                    INSERT INTO measurements (recorded_at, station_id, temperature_f)
-                    VALUES (%s, %s, %s)
-                """
-                cursor.execute(insert_query, (timestamp, location, temp))
-                connection.commit()
-                #print(cursor.query)
-
-        cursor.close()
-        connection.close()
-    except psycopg2.DatabaseError as e:
-        print(f"Database error: {e}")
+        readings = scan_thermostat_log(lines)
     except Exception as e:
         print(f"Unexpected error: {e}")
+        return results
 
+    for stat, (timestamp_str, indoor_temp, indoor_humid) in readings.items():
+        try:
+            os.remove(tmpfile)
+        except:
+            pass
 
-## MAIN ##
-if __name__ == "__main__":
-    ensure_directory_exists(output_file_path)
-
-    # Main tstat
-    result = extract_indoor_temperature_from_log("MAIN")
-    if result:
-        ts, loc, temp, humid = result
-        insert_into_database(ts, 0, temp, humid, None)
-    
-    # George tstat
-    result = extract_indoor_temperature_from_log("GEORGE")
-    if result:
-        ts, loc, temp, humid = result
-        insert_into_database(ts, 1, temp, None, None)
-
-    # MBR tstat
-    result = extract_indoor_temperature_from_log("MBR")
-    if result:
-        ts, loc, temp, humid = result
-        insert_into_database(ts, 2, temp, None, None)
+        try:
+            rfc822_timestamp, pg_timestamp = omnistat_timestamps(timestamp_str)
 
-    # Midway weather station
+            # Write to /var/environment
+            with open(tmpfile, 'w') as output_file:
+                output_file.write(f"{rfc822_timestamp}\t{indoor_temp}\t{stat}\n")
+            os.rename(tmpfile, TSTATS[stat]["outfile"])
+
+            results[stat] = (pg_timestamp, stat, indoor_temp, indoor_humid)
+        except ValueError as e:
+            print(f"Error parsing timestamp {timestamp_str}: {e}")
+        except Exception as e:
+            print(f"Unexpected error: {e}")
+
+    return results
+
+
+# Returns measurements rows for every thermostat with a new reading
+def update_thermostats():
+    # Only what MisterHouse logged since the last run
+    lines = read_new_log_lines()
+
+    # All Omnistat thermostats in one pass
+    rows = []
+    results = extract_indoor_temperatures_from_log(lines)
+    for stat, (ts, loc, temp, humid) in results.items():
+        rows.append({
+            "recorded_at": ts,
+            "station_id": TSTATS[stat]["station"],
+            "temperature_f": temp,
+            "humidity_percent": humid,
+        })
+    return rows
+
+
+# Returns the measurements row for the Midway weather station, if any
+def update_midway():
     result = extract_temperature_from_xml()
     if result:
         ts, loc, temp, humid, pressure = result
-        insert_into_database(ts, 100, temp, humid, pressure)
+        return [{
+            "recorded_at": ts,
+            "station_id": 100,
+            "temperature_f": temp,
+            "humidity_percent": humid,
+            "pressure_inhg": pressure,
+        }]
+    return []
+
+
+# Stay resident and update as soon as MisterHouse writes the Omnistat log
+# or the Midway XML. Readings go to the outbox and a background thread
+# drains it over a DB connection kept open between updates.
+def run_daemon():
+    outbox.start_flusher()
+
+    watcher = fswatch.Watcher()
+    watcher.add(tstat_input_file_path, fswatch.IN_CHANGED)
+    # The XML is only complete once it is closed or renamed into place
+    watcher.add(mdw_input_file_path, fswatch.IN_REPLACED)
+    print(f"Watching {tstat_input_file_path} and {mdw_input_file_path}")
+
+    changed = {tstat_input_file_path, mdw_input_file_path}
+    while True:
+        rows = []
+        if tstat_input_file_path in changed:
+            rows += update_thermostats()
+        if mdw_input_file_path in changed:
+            rows += update_midway()
+        outbox.write("measurements", rows)
+
+        changed = watcher.read(timeout=DAEMON_RESCAN_TIME)
+        if not changed:
+            changed = {tstat_input_file_path, mdw_input_file_path}
+
+
+def quit_handler(signum, frame):
+    print(f"Signal {signum} received. Cleaning-up and exiting")
+    # The flusher may be mid-write, don't close the pool under it
+    if outbox.stop_flusher():
+        envdb.close()
+    else:
+        print("Outbox flusher still busy, exiting without closing the database pool")
+    sys.exit(0)
+
+
+## MAIN ##
+if __name__ == "__main__":
+    ensure_directory_exists(output_file_path)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--daemon":
+        signal.signal(signal.SIGINT, quit_handler)
+        signal.signal(signal.SIGQUIT, quit_handler)
+        signal.signal(signal.SIGTERM, quit_handler)
+        run_daemon()
+    else:
+        # Spool everything from this run, then send it (and anything left
+        # over from runs when the DB was down) in one go
+        outbox.write("measurements", update_thermostats() + update_midway())
+        outbox.flush()
+        envdb.close()